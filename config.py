@@ -1,46 +1,125 @@
 """Configuration management for the email quiz service."""
+import functools
 import os
-from dotenv import load_dotenv
+from collections import deque
+from dataclasses import dataclass
+from typing import Tuple
+import orjson
+from dotenv import dotenv_values
 
-load_dotenv()
 
-# Gmail API Configuration
-GMAIL_CREDENTIALS_FILE = os.getenv("GMAIL_CREDENTIALS_FILE", "credentials.json")
-GMAIL_TOKEN_FILE = os.getenv("GMAIL_TOKEN_FILE", "token.json")
-GMAIL_SCOPES = ['https://www.googleapis.com/auth/gmail.send', 'https://www.googleapis.com/auth/gmail.readonly']
+@functools.lru_cache(maxsize=1)
+def _load_env() -> dict:
+    """Parse .env once and overlay the process environment (which takes precedence)."""
+    env = {k: v for k, v in dotenv_values().items() if v is not None}
+    env.update(os.environ)
+    return env
 
-# Email Configuration
-TARGET_EMAIL = os.getenv("TARGET_EMAIL", "")
-EMAIL_THREAD_ID = os.getenv("EMAIL_THREAD_ID", "")  # Optional: if empty, will create new thread
-EMAIL_SUBJECT = os.getenv("EMAIL_SUBJECT", "Quiz Question")  # Email thread subject/title
 
-# Gemini API Configuration
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
+def _getenv(key: str, default: str = "") -> str:
+    """Look up a setting from the cached environment."""
+    return _load_env().get(key, default)
 
-# Service Configuration
-QUESTIONS_CSV = os.getenv("QUESTIONS_CSV", "review_questions_answer_table.csv")
-STATE_FILE = os.getenv("STATE_FILE", "state.json")
-SCORES_FILE = os.getenv("SCORES_FILE", "scores.json")  # Track scores per question
-PROGRESS_FILE = os.getenv("PROGRESS_FILE", "progress.json")  # Track detailed progress history
-REVIEW_SHEET = os.getenv("REVIEW_SHEET", "Galaxie Review Sheet.txt")  # Review sheet for context
-POLL_INTERVAL_SECONDS = int(os.getenv("POLL_INTERVAL_SECONDS", "30"))  # How often to check for responses
-QUESTION_INTERVAL_MINUTES = int(os.getenv("QUESTION_INTERVAL_MINUTES", "10"))  # Time between questions
 
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Service settings, read once from the environment."""
+    # Gmail API Configuration
+    gmail_credentials_file: str
+    gmail_token_file: str
+    gmail_scopes: Tuple[str, ...]
+    
+    # Email Configuration
+    target_email: str
+    email_thread_id: str  # Optional: if empty, will create new thread
+    email_subject: str  # Email thread subject/title
+    
+    # Gemini API Configuration
+    gemini_api_key: str
+    gemini_transport: str  # 'grpc' (persistent HTTP/2 channel) or 'rest'
+    gemini_requests_per_minute: int  # Client-side cap on Gemini calls
+    
+    # Service Configuration
+    questions_csv: str
+    state_file: str
+    scores_file: str  # Track scores per question
+    progress_file: str  # Track detailed progress history
+    review_sheet: str  # Review sheet for context
+    grade_cache_file: str  # SQLite cache of Gemini grading replies
+    semantic_grade_cache: bool  # Reuse grades of near-identical earlier answers (off by default)
+    poll_interval_seconds: int  # How often to check for responses
+    question_interval_minutes: int  # Time between questions
+
+@functools.lru_cache(maxsize=1)
+def get_config() -> Config:
+    """Build the service configuration (cached, so the environment is read once)."""
+    return Config(
+        gmail_credentials_file=_getenv("GMAIL_CREDENTIALS_FILE", "credentials.json"),
+        gmail_token_file=_getenv("GMAIL_TOKEN_FILE", "token.json"),
+        gmail_scopes=(
+            'https://www.googleapis.com/auth/gmail.send',
+            'https://www.googleapis.com/auth/gmail.readonly',
+        ),
+        target_email=_getenv("TARGET_EMAIL", ""),
+        email_thread_id=_getenv("EMAIL_THREAD_ID", ""),
+        email_subject=_getenv("EMAIL_SUBJECT", "Quiz Question"),
+        gemini_api_key=_getenv("GEMINI_API_KEY", ""),
+        gemini_transport=_getenv("GEMINI_TRANSPORT", "grpc"),
+        gemini_requests_per_minute=int(_getenv("GEMINI_REQUESTS_PER_MINUTE", "60")),
+        questions_csv=_getenv("QUESTIONS_CSV", "review_questions_answer_table.csv"),
+        state_file=_getenv("STATE_FILE", "state.json"),
+        scores_file=_getenv("SCORES_FILE", "scores.json"),
+        progress_file=_getenv("PROGRESS_FILE", "progress.json"),
+        review_sheet=_getenv("REVIEW_SHEET", "Galaxie Review Sheet.txt"),
+        grade_cache_file=_getenv("GRADE_CACHE_FILE", "grade_cache.db"),
+        semantic_grade_cache=_getenv("SEMANTIC_GRADE_CACHE", "false").lower() in ('1', 'true', 'yes'),
+        poll_interval_seconds=int(_getenv("POLL_INTERVAL_SECONDS", "30")),
+        question_interval_minutes=int(_getenv("QUESTION_INTERVAL_MINUTES", "10")),
+    )
+
+def load_json(path: str):
+    """Load a JSON file (state, scores, progress) using orjson."""
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())
+
+def _json_default(obj):
+    """orjson fallback, only called for values it can't serialize natively."""
+    if isinstance(obj, (deque, set)):
+        return list(obj)
+    if hasattr(obj, 'item'):
+        # numpy scalar types orjson doesn't cover (e.g. np.bool_ in older orjson)
+        return obj.item()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+def save_json(path: str, obj):
+    """Write an object to a compact JSON file using orjson (int keys and numpy values are allowed)."""
+    with open(path, 'wb') as f:
+        f.write(orjson.dumps(obj, default=_json_default,
+                             option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY))
+
+def write_jsonl(path: str, entries: list, append: bool = True):
+    """Write entries to a JSON Lines file, one compact JSON object per line (appending by default)."""
+    with open(path, 'ab' if append else 'wb') as f:
+        f.write(b''.join(orjson.dumps(entry, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY) + b'\n'
+                         for entry in entries))
+
+@functools.lru_cache(maxsize=1)
 def validate_config():
-    """Validate that required configuration is present."""
+    """Validate that required configuration is present (checked once per process)."""
+    cfg = get_config()
     errors = []
     
-    if not GEMINI_API_KEY:
+    if not cfg.gemini_api_key:
         errors.append("GEMINI_API_KEY is required in .env file")
     
-    if not TARGET_EMAIL:
+    if not cfg.target_email:
         errors.append("TARGET_EMAIL is required in .env file")
     
-    if not os.path.exists(GMAIL_CREDENTIALS_FILE):
-        errors.append(f"Gmail credentials file not found: {GMAIL_CREDENTIALS_FILE}")
+    if not os.path.exists(cfg.gmail_credentials_file):
+        errors.append(f"Gmail credentials file not found: {cfg.gmail_credentials_file}")
     
-    if not os.path.exists(QUESTIONS_CSV):
-        errors.append(f"Questions CSV file not found: {QUESTIONS_CSV}")
+    if not os.path.exists(cfg.questions_csv):
+        errors.append(f"Questions CSV file not found: {cfg.questions_csv}")
     
     if errors:
         raise ValueError("Configuration errors:\n" + "\n".join(f"  - {e}" for e in errors))
@@ -1,46 +1,184 @@
 """Gmail API service for sending and receiving quiz emails."""
 import base64
+import functools
 import json
 import os
-from datetime import datetime
-from email.mime.text import MIMEText
-from typing import Optional, List, Dict
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+import quopri
+import re
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from email.header import Header
+from typing import Optional, List, Dict, Set, Tuple
 from googleapiclient.errors import HttpError
-import config
+from config import get_config
+
+try:
+    # Optional C-backed HTML parser; falls back to regex tag stripping if missing
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
+try:
+    # Optional C++ fuzzy matcher for the quote-of-question check
+    from rapidfuzz import fuzz
+except ImportError:
+    fuzz = None
+
+# Refresh the OAuth access token this many seconds before it expires
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+# Never re-arm the refresh timer sooner than this (guards against tight loops)
+TOKEN_REFRESH_MIN_DELAY_SECONDS = 30
+# Upper bound for the retry backoff after a failed background refresh
+TOKEN_REFRESH_MAX_BACKOFF_SECONDS = 600
+# How many sent messages to remember (timestamp + text) across polls
+SENT_MESSAGE_CACHE_SIZE = 32
+# Socket timeout for the shared Gmail API HTTP connection
+GMAIL_HTTP_TIMEOUT_SECONDS = 60
+# Headers requested when polling a thread in metadata format
+CHECK_METADATA_HEADERS = ['From']
+# RFC 5322 line length limit in octets, not counting the CRLF
+MAX_LINE_OCTETS = 998
+
+# Precompiled patterns used when parsing messages
+_REDIRECT_RE = re.compile(r'redirect_uri=([^\s]+)')
+_HTML_TAG_RE = re.compile(r'<[^<]+?>')
+_QUOTE_LINE_RE = re.compile(r'^>.*$', re.MULTILINE)
+_ON_WROTE_RE = re.compile(r'On .+ wrote:.*$', re.MULTILINE | re.DOTALL)
+_BLANK_LINES_RE = re.compile(r'\n\s*\n')
+
+# Line prefixes that mark one of our own feedback emails (see format_feedback_message)
+_FEEDBACK_MARKERS = ('score:', 'your score:', 'feedback:', 'missing points:')
+
+
+def _html_to_text(html: str) -> str:
+    """Convert an HTML email body to plain text."""
+    if HTMLParser is not None:
+        return HTMLParser(html).text(separator=' ', strip=True)
+    # Simple HTML tag removal (basic implementation)
+    return _HTML_TAG_RE.sub('', html)
+
+
+@functools.lru_cache(maxsize=128)
+def _decode_part_text(data: str, mime_type: str) -> str:
+    """Decode a base64url message part body to text, memoized on the encoded data."""
+    # Decoding bytes skips b64decode's internal str->ASCII step; 'replace' keeps a
+    # malformed email from crashing the poll loop
+    text = base64.urlsafe_b64decode(data.encode('ascii')).decode('utf-8', errors='replace')
+    if mime_type == 'text/html':
+        return _html_to_text(text)
+    return text
+
+
+
+def _question_overlap(question_text: str, response_text: str) -> float:
+    """
+    Estimate how much of a response is just the (lowercased) question quoted back.
+    
+    Returns:
+        Similarity from 0.0 to 1.0
+    """
+    response_lower = response_text.lower()
+    if fuzz is not None:
+        question_head = question_text[:200]
+        # partial_ratio scores the shorter string against its best-matching slice of the
+        # longer one, so a short answer that reuses a few of the question's words would
+        # score 1.0; only use it when the response could hold the whole question head
+        if len(response_lower) >= len(question_head):
+            return fuzz.partial_ratio(question_head, response_lower) / 100.0
+        return fuzz.ratio(question_head, response_lower) / 100.0
+    # Fraction of the question's first 10 words that appear in the response
+    question_words = set(question_text.split()[:10])
+    response_words = set(response_lower.split())
+    return len(question_words & response_words) / max(len(question_words), 1)
+
+
+
+def _make_raw(to: str, subject: str, body: str) -> str:
+    """
+    Build a base64url-encoded RFC 5322 plain-text message for the Gmail API.
+    
+    Args:
+        to: Recipient address
+        subject: Subject line
+        body: Plain text body
+    
+    Returns:
+        Value for the 'raw' field of a Gmail send request
+    """
+    subject = ' '.join(subject.splitlines())  # Headers can't contain line breaks
+    if not subject.isascii():
+        subject = Header(subject, 'utf-8').encode()
+    
+    # Plain ASCII with short lines goes as-is; anything else (e.g. long single-paragraph
+    # feedback) is quoted-printable, which wraps lines at 76 characters
+    lines = body.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    if body.isascii() and all(len(line) <= MAX_LINE_OCTETS for line in lines):
+        encoding = '7bit'
+        body_bytes = '\r\n'.join(lines).encode('ascii')
+    else:
+        encoding = 'quoted-printable'
+        body_bytes = quopri.encodestring('\n'.join(lines).encode('utf-8')).replace(b'\n', b'\r\n')
+    
+    header = (
+        f"To: {to}\r\n"
+        f"Subject: {subject}\r\n"
+        "MIME-Version: 1.0\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        f"Content-Transfer-Encoding: {encoding}\r\n"
+        "\r\n"
+    )
+    return base64.urlsafe_b64encode(header.encode('utf-8') + body_bytes).decode('ascii')
 
 
 class EmailService:
     """Handles Gmail API operations for quiz emails."""
     
     def __init__(self):
+        self.config = get_config()
         self.service = None
         self.credentials = None
+        self._refresh_timer = None
+        self._refresh_backoff = 0
+        # {message_id: (internalDate, extracted_text)}, oldest first
+        self._sent_msg_cache = OrderedDict()
+        # Newest mailbox historyId seen; later polls only ask Gmail for what changed
+        self._last_history_id = None
+        # {thread_id: historyId} as of the last completed check_for_response
+        self._thread_history_ids = {}
         self._authenticate()
+        self._schedule_token_refresh()
     
     def _authenticate(self):
         """Authenticate with Gmail API using OAuth2."""
+        # Heavy auth/discovery modules are imported here rather than at module
+        # level so importing this module (e.g. for --help) stays fast
+        import google_auth_httplib2
+        import httplib2
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        from googleapiclient.discovery import build
+        
         creds = None
         
         # Load existing token if available
-        if os.path.exists(config.GMAIL_TOKEN_FILE):
-            creds = Credentials.from_authorized_user_file(config.GMAIL_TOKEN_FILE, config.GMAIL_SCOPES)
+        if os.path.exists(self.config.gmail_token_file):
+            creds = Credentials.from_authorized_user_file(self.config.gmail_token_file, self.config.gmail_scopes)
         
         # If there are no (valid) credentials available, let the user log in
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
                 creds.refresh(Request())
             else:
-                if not os.path.exists(config.GMAIL_CREDENTIALS_FILE):
+                if not os.path.exists(self.config.gmail_credentials_file):
                     raise FileNotFoundError(
-                        f"Gmail credentials file not found: {config.GMAIL_CREDENTIALS_FILE}\n"
+                        f"Gmail credentials file not found: {self.config.gmail_credentials_file}\n"
                         "Please download OAuth2 credentials from Google Cloud Console."
                     )
                 flow = InstalledAppFlow.from_client_secrets_file(
-                    config.GMAIL_CREDENTIALS_FILE, config.GMAIL_SCOPES
+                    self.config.gmail_credentials_file, self.config.gmail_scopes
                 )
                 # Use fixed port 8080 - must match redirect URI in Google Cloud Console
                 try:
@@ -49,8 +187,7 @@ class EmailService:
                     error_str = str(e).lower()
                     if 'redirect_uri_mismatch' in error_str or '400' in error_str:
                         # Extract the redirect URI from error if possible
-                        import re
-                        redirect_match = re.search(r'redirect_uri=([^\s]+)', str(e))
+                        redirect_match = _REDIRECT_RE.search(str(e))
                         redirect_uri = redirect_match.group(1) if redirect_match else 'http://localhost:8080'
                         
                         raise Exception(
@@ -76,11 +213,70 @@ class EmailService:
                     raise
             
             # Save credentials for next run
-            with open(config.GMAIL_TOKEN_FILE, 'w') as token:
-                token.write(creds.to_json())
+            self._save_token(creds)
         
         self.credentials = creds
-        self.service = build('gmail', 'v1', credentials=creds)
+        # One long-lived authorized HTTP client so every API call reuses the same
+        # keep-alive TLS connection to gmail.googleapis.com
+        self.http = google_auth_httplib2.AuthorizedHttp(
+            creds, http=httplib2.Http(timeout=GMAIL_HTTP_TIMEOUT_SECONDS)
+        )
+        self.service = build('gmail', 'v1', http=self.http, cache_discovery=False)
+    
+    def _save_token(self, creds):
+        """Atomically write credentials to the token file (no partial writes on crash)."""
+        token_dir = os.path.dirname(os.path.abspath(self.config.gmail_token_file))
+        fd, tmp_path = tempfile.mkstemp(dir=token_dir, prefix='.token-', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as token:
+                token.write(creds.to_json())
+            os.replace(tmp_path, self.config.gmail_token_file)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    
+    def _schedule_token_refresh(self, delay: Optional[float] = None):
+        """Arm a background timer that refreshes the access token before it expires.
+        
+        Args:
+            delay: Seconds until the refresh. If None, derived from the token expiry.
+        """
+        if delay is None:
+            expiry = getattr(self.credentials, 'expiry', None)
+            if expiry is None or not getattr(self.credentials, 'refresh_token', None):
+                return  # Nothing to refresh ahead of time
+            # google-auth stores expiry as a naive UTC datetime
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            delay = (expiry - now).total_seconds() - TOKEN_REFRESH_MARGIN_SECONDS
+        delay = max(delay, TOKEN_REFRESH_MIN_DELAY_SECONDS)
+        
+        self._refresh_timer = threading.Timer(delay, self._refresh_token)
+        self._refresh_timer.daemon = True  # Don't keep the process alive on exit
+        self._refresh_timer.start()
+    
+    def _refresh_token(self):
+        """Refresh the access token in the background and re-arm the timer."""
+        from google.auth.transport.requests import Request
+        
+        try:
+            # Deliberately unlocked: AuthorizedHttp can also refresh inline on the main thread
+            # and wouldn't take a lock here; at worst the token is refreshed twice, and
+            # _save_token's atomic replace keeps the token file whole either way
+            self.credentials.refresh(Request())
+            self._save_token(self.credentials)
+        except Exception as e:
+            # Exponential backoff; the API client still refreshes inline as a last resort
+            self._refresh_backoff = min(
+                max(self._refresh_backoff * 2, TOKEN_REFRESH_MIN_DELAY_SECONDS),
+                TOKEN_REFRESH_MAX_BACKOFF_SECONDS
+            )
+            print(f"Warning: Background token refresh failed: {e} (retrying in {self._refresh_backoff}s)")
+            self._schedule_token_refresh(self._refresh_backoff)
+            return
+        
+        self._refresh_backoff = 0
+        self._schedule_token_refresh()
     
     def send_question(self, question: str, thread_id: Optional[str] = None, subject: Optional[str] = None) -> Dict:
         """
@@ -88,14 +284,14 @@ class EmailService:
         
         Args:
             question: The question text to send
-            thread_id: Optional thread ID to reply to. If None and config has thread ID, uses that.
-            subject: Optional email subject. If None, uses config.EMAIL_SUBJECT
+            thread_id: Optional thread ID to reply to. If None and the config has a thread ID, uses that.
+            subject: Optional email subject. If None, uses self.config.email_subject
         
         Returns:
             Dict with 'id' (message ID) and 'threadId' (thread ID)
         """
         if thread_id is None:
-            thread_id = config.EMAIL_THREAD_ID
+            thread_id = self.config.email_thread_id
         
         # Handle empty string thread_id (create new thread)
         # Also validate that thread_id looks like a valid Gmail thread ID (long alphanumeric)
@@ -114,13 +310,13 @@ class EmailService:
         
         # Use provided subject or default from config
         if subject is None:
-            subject = config.EMAIL_SUBJECT
+            subject = self.config.email_subject
         
-        message = MIMEText(question)
-        message['to'] = config.TARGET_EMAIL
-        message['subject'] = subject if not thread_id else f'Re: {subject}'
-        
-        raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
+        raw_message = _make_raw(
+            self.config.target_email,
+            subject if not thread_id else f'Re: {subject}',
+            question
+        )
         
         body = {'raw': raw_message}
         # Only add threadId if it's a valid non-empty string
@@ -146,19 +342,15 @@ class EmailService:
         Args:
             feedback: The feedback text to send
             thread_id: Thread ID to reply to
-            subject: Optional email subject. If None, uses config.EMAIL_SUBJECT
+            subject: Optional email subject. If None, uses self.config.email_subject
         
         Returns:
             Dict with 'id' (message ID) and 'threadId' (thread ID)
         """
         if subject is None:
-            subject = config.EMAIL_SUBJECT
-        
-        message = MIMEText(feedback)
-        message['to'] = config.TARGET_EMAIL
-        message['subject'] = f'Re: {subject}'
+            subject = self.config.email_subject
         
-        raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
+        raw_message = _make_raw(self.config.target_email, f'Re: {subject}', feedback)
         
         body = {
             'raw': raw_message,
@@ -176,19 +368,21 @@ class EmailService:
         except HttpError as error:
             raise Exception(f"Error sending feedback: {error}")
     
-    def get_thread_messages(self, thread_id: str) -> List[Dict]:
+    def get_thread_messages(self, thread_id: str, fmt: str = 'full', metadata_headers: Optional[List[str]] = None) -> List[Dict]:
         """
         Get all messages in a thread.
         
         Args:
             thread_id: Thread ID to retrieve messages from
+            fmt: Gmail message format ('full', 'metadata', 'minimal')
+            metadata_headers: Headers to include when fmt is 'metadata'
         
         Returns:
             List of message dictionaries with 'id', 'snippet', 'payload', etc.
         """
         try:
             thread = self.service.users().threads().get(
-                userId='me', id=thread_id
+                userId='me', id=thread_id, format=fmt, metadataHeaders=metadata_headers
             ).execute()
             
             return thread.get('messages', [])
@@ -206,20 +400,16 @@ class EmailService:
         Returns:
             Latest message dict or None if no new messages
         """
-        if exclude_message_ids is None:
-            exclude_message_ids = []
+        exclude_set = set(exclude_message_ids or ())
         
         messages = self.get_thread_messages(thread_id)
         
-        # Sort by internal date (newest first)
-        messages.sort(key=lambda m: int(m.get('internalDate', 0)), reverse=True)
-        
-        # Find first message not in exclude list
-        for message in messages:
-            if message['id'] not in exclude_message_ids:
-                return message
-        
-        return None
+        # Newest message not in the exclude list (single pass, no sort needed)
+        return max(
+            (m for m in messages if m['id'] not in exclude_set),
+            key=lambda m: int(m.get('internalDate', 0)),
+            default=None
+        )
     
     def extract_message_text(self, message: Dict) -> str:
         """
@@ -231,33 +421,214 @@ class EmailService:
         Returns:
             Plain text content of the message
         """
-        payload = message.get('payload', {})
-        
-        def extract_from_part(part):
-            """Recursively extract text from message parts."""
-            if part.get('mimeType') == 'text/plain':
-                data = part.get('body', {}).get('data')
-                if data:
-                    return base64.urlsafe_b64decode(data).decode('utf-8')
-            elif part.get('mimeType') == 'text/html':
-                # Fallback to HTML if plain text not available
-                data = part.get('body', {}).get('data')
-                if data:
-                    html = base64.urlsafe_b64decode(data).decode('utf-8')
-                    # Simple HTML tag removal (basic implementation)
-                    import re
-                    return re.sub('<[^<]+?>', '', html)
-            
-            # Check for multipart
-            parts = part.get('parts', [])
-            for subpart in parts:
-                text = extract_from_part(subpart)
-                if text:
-                    return text
-            
-            return ""
+        # Breadth-first walk over the MIME tree: the first text/plain part wins,
+        # and the first text/html part is only used if there is no plain text
+        pending = deque([message.get('payload', {})])
+        html_data = None
+        while pending:
+            part = pending.popleft()
+            mime_type = part.get('mimeType')
+            data = part.get('body', {}).get('data')
+            if data:
+                if mime_type == 'text/plain':
+                    return _decode_part_text(data, mime_type)
+                if mime_type == 'text/html' and html_data is None:
+                    html_data = data
+            pending.extend(part.get('parts', ()))
+        
+        if html_data is not None:
+            return _decode_part_text(html_data, 'text/html')
+        return ""
+    
+    def get_message_timestamp(self, message_id: str) -> int:
+        """
+        Get the Gmail timestamp of a message we sent.
+        
+        The message is kept in the sent-message cache, so the first response
+        check for it doesn't need to fetch it again.
+        
+        Args:
+            message_id: Message ID of a service-sent message
         
-        return extract_from_part(payload)
+        Returns:
+            internalDate in milliseconds since the epoch
+        """
+        return self._get_sent_message(message_id)[0]
+    
+    def _get_sent_message(self, message_id: str) -> Tuple[int, str]:
+        """
+        Get the timestamp and text of a message we sent, memoized per message ID.
+        
+        Args:
+            message_id: Message ID of a service-sent message
+        
+        Returns:
+            Tuple of (internalDate in ms, extracted plain text)
+        """
+        if message_id in self._sent_msg_cache:
+            self._sent_msg_cache.move_to_end(message_id)
+            return self._sent_msg_cache[message_id]
+        
+        sent_msg = self.service.users().messages().get(
+            userId='me', id=message_id
+        ).execute()
+        return self._cache_sent_message(message_id, sent_msg)
+    
+    def _cache_sent_message(self, message_id: str, sent_msg: Dict) -> Tuple[int, str]:
+        """Store a fetched sent message in the bounded cache and return its entry."""
+        entry = (int(sent_msg.get('internalDate', 0)), self.extract_message_text(sent_msg))
+        
+        self._sent_msg_cache[message_id] = entry
+        if len(self._sent_msg_cache) > SENT_MESSAGE_CACHE_SIZE:
+            self._sent_msg_cache.popitem(last=False)
+        return entry
+    
+    def _get_thread_with_sent_message(self, thread_id: str, sent_message_id: str) -> List[Dict]:
+        """
+        Get a thread's message metadata, fetching the sent question in the same round-trip.
+        
+        If the sent message is not cached yet, the threads.get and messages.get
+        calls are combined into one batch HTTP request and the sent message is
+        added to the cache.
+        
+        Args:
+            thread_id: Thread ID to retrieve messages from
+            sent_message_id: Message ID of the question we sent
+        
+        Returns:
+            List of message dictionaries (metadata format, 'From' header only)
+        """
+        if not sent_message_id or sent_message_id in self._sent_msg_cache:
+            return self.get_thread_messages(thread_id, fmt='metadata', metadata_headers=CHECK_METADATA_HEADERS)
+        
+        results = {}
+        
+        def store(request_id, response, exception):
+            results[request_id] = (response, exception)
+        
+        batch = self.service.new_batch_http_request(callback=store)
+        batch.add(
+            self.service.users().threads().get(
+                userId='me', id=thread_id, format='metadata', metadataHeaders=CHECK_METADATA_HEADERS
+            ),
+            request_id='thread'
+        )
+        batch.add(self.service.users().messages().get(userId='me', id=sent_message_id), request_id='sent')
+        try:
+            batch.execute()
+        except HttpError as error:
+            raise Exception(f"Error retrieving thread: {error}")
+        
+        sent_msg, sent_error = results.get('sent', (None, None))
+        if sent_msg is not None and sent_error is None:
+            self._cache_sent_message(sent_message_id, sent_msg)
+        
+        thread, thread_error = results.get('thread', (None, None))
+        if thread_error is not None or thread is None:
+            raise Exception(f"Error retrieving thread: {thread_error}")
+        return thread.get('messages', [])
+    
+    def _get_messages(self, message_ids: List[str], fmt: str = 'full', metadata_headers: List[str] = None) -> Dict[str, Dict]:
+        """
+        Fetch message payloads, batching multiple IDs into one HTTP request.
+        
+        Args:
+            message_ids: Message IDs to fetch
+            fmt: Message format to request ('full' or 'metadata')
+            metadata_headers: Headers to include when fmt is 'metadata'
+        
+        Returns:
+            Dict of message ID -> message dict (IDs that failed are omitted)
+        """
+        kwargs = {'format': fmt}
+        if metadata_headers:
+            kwargs['metadataHeaders'] = metadata_headers
+        
+        if not message_ids:
+            return {}
+        if len(message_ids) == 1:
+            try:
+                message = self.service.users().messages().get(
+                    userId='me', id=message_ids[0], **kwargs
+                ).execute()
+                return {message_ids[0]: message}
+            except HttpError:
+                return {}
+        
+        results = {}
+        
+        def store(request_id, response, exception):
+            if exception is None and response is not None:
+                results[request_id] = response
+        
+        batch = self.service.new_batch_http_request(callback=store)
+        for message_id in message_ids:
+            batch.add(
+                self.service.users().messages().get(userId='me', id=message_id, **kwargs),
+                request_id=message_id
+            )
+        try:
+            batch.execute()
+        except HttpError as error:
+            print(f"[DEBUG] Batch message fetch failed: {error}")
+        return results
+    
+    def _get_new_thread_messages(self, thread_id: str, sent_message_id: str, exclude_message_ids: Set[str]) -> List[Dict]:
+        """
+        Get the thread messages worth checking for a response, filtered server-side.
+        
+        The first call fetches the whole thread and records the newest historyId.
+        Later calls use history.list to find messages added since that watermark
+        and only fetch full payloads for the ones in this thread that aren't excluded.
+        
+        Args:
+            thread_id: Thread ID to check
+            sent_message_id: Message ID of the question we sent
+            exclude_message_ids: Message IDs that can never be a response
+        
+        Returns:
+            List of message dictionaries (metadata format, 'From' header only)
+        """
+        if self._last_history_id is not None:
+            try:
+                new_ids = []
+                seen_ids = set()
+                page_token = None
+                while True:
+                    history = self.service.users().history().list(
+                        userId='me',
+                        startHistoryId=self._last_history_id,
+                        historyTypes=['messageAdded'],
+                        pageToken=page_token
+                    ).execute()
+                    for record in history.get('history', []):
+                        for added in record.get('messagesAdded', []):
+                            message = added.get('message', {})
+                            message_id = message.get('id')
+                            if (message.get('threadId') == thread_id
+                                    and message_id not in exclude_message_ids
+                                    and message_id not in seen_ids):
+                                seen_ids.add(message_id)
+                                new_ids.append(message_id)
+                    page_token = history.get('nextPageToken')
+                    if not page_token:
+                        break
+                
+                # One batch HTTP request for all the new messages' metadata
+                fetched = self._get_messages(new_ids, fmt='metadata', metadata_headers=CHECK_METADATA_HEADERS)
+                if len(fetched) == len(new_ids):
+                    self._last_history_id = history.get('historyId', self._last_history_id)
+                    return [fetched[message_id] for message_id in new_ids]
+                print("[DEBUG] Some new messages couldn't be fetched, fetching full thread")
+            except HttpError as error:
+                # startHistoryId too old (404) or message gone: fall back to a full fetch
+                print(f"[DEBUG] History lookup failed ({error}), fetching full thread")
+        
+        messages = self._get_thread_with_sent_message(thread_id, sent_message_id)
+        history_ids = [int(m['historyId']) for m in messages if m.get('historyId')]
+        if history_ids:
+            self._last_history_id = str(max(history_ids))
+        return messages
     
     def check_for_response(self, thread_id: str, sent_message_id: str, sent_message_timestamp: int = None, exclude_message_ids: List[str] = None) -> Optional[str]:
         """
@@ -272,25 +643,53 @@ class EmailService:
         Returns:
             Response text if found, None otherwise
         """
-        if exclude_message_ids is None:
-            exclude_message_ids = []
+        # Constant-time no-op when nothing in the thread changed since the last poll
+        thread_history_id = self._get_thread_history_id(thread_id)
+        if thread_history_id is not None and self._thread_history_ids.get(thread_id) == thread_history_id:
+            return None
+        
+        previous_history_id = self._last_history_id
+        try:
+            response = self._scan_for_response(
+                thread_id, sent_message_id, sent_message_timestamp, exclude_message_ids
+            )
+        except Exception:
+            # Rewind the history watermark so the next poll sees the same messages again
+            self._last_history_id = previous_history_id
+            raise
+        
+        # Only advance the watermark once the scan completed without raising
+        if thread_history_id is not None:
+            self._thread_history_ids[thread_id] = thread_history_id
+        return response
+    
+    def _get_thread_history_id(self, thread_id: str) -> Optional[str]:
+        """Get a thread's current historyId, or None if it can't be fetched."""
+        try:
+            thread = self.service.users().threads().get(
+                userId='me', id=thread_id, format='minimal', fields='historyId'
+            ).execute()
+            return thread.get('historyId')
+        except HttpError:
+            return None
+    
+    def _scan_for_response(self, thread_id: str, sent_message_id: str, sent_message_timestamp: Optional[int], exclude_message_ids: Optional[List[str]]) -> Optional[str]:
+        """Scan the thread's new messages for a valid user response (see check_for_response)."""
+        exclude_set = set(exclude_message_ids or ())
         
         # Always exclude the sent message ID
-        if sent_message_id not in exclude_message_ids:
-            exclude_message_ids.append(sent_message_id)
+        exclude_set.add(sent_message_id)
+        
+        # Get thread messages added since the last poll (full thread on the first poll)
+        messages = self._get_new_thread_messages(thread_id, sent_message_id, exclude_set)
         
         # Get the sent message to find its timestamp
         if sent_message_timestamp is None:
             try:
-                sent_msg = self.service.users().messages().get(
-                    userId='me', id=sent_message_id
-                ).execute()
-                sent_message_timestamp = int(sent_msg.get('internalDate', 0))
+                sent_message_timestamp, _ = self._get_sent_message(sent_message_id)
             except:
                 sent_message_timestamp = 0
         
-        # Get all messages in thread
-        messages = self.get_thread_messages(thread_id)
         print(f"[DEBUG] Checking thread with {len(messages)} messages")
         
         # Filter for messages that:
@@ -299,12 +698,25 @@ class EmailService:
         # 3. Are from the user (target email), not from "me" (service account)
         buffer_ms = 2000  # 2 second buffer to avoid picking up messages sent at the same time
         
+        # The question text is the same for every message, so look it up once up front
+        # (used to reject responses that are just a quote of the question)
+        question_text = None
+        if sent_message_id and messages:
+            try:
+                _, sent_text = self._get_sent_message(sent_message_id)
+                if sent_text and len(sent_text) > 10:
+                    question_text = sent_text.lower()
+            except:
+                pass
+        
+        # First pass: cheap metadata checks; collect candidates in thread order
+        candidates = []
         for i, message in enumerate(messages):
             message_id = message.get('id')
             message_timestamp = int(message.get('internalDate', 0))
             
             # Skip any service-sent messages (questions, feedback, etc.)
-            if message_id in exclude_message_ids:
+            if message_id in exclude_set:
                 continue
             
             # Only consider messages sent AFTER the question (with buffer)
@@ -319,10 +731,10 @@ class EmailService:
             
             # Must be from target email, and NOT from "me" (service account)
             from_lower = from_header.lower()
-            target_lower = config.TARGET_EMAIL.lower()
+            target_lower = self.config.target_email.lower()
             
             print(f"[DEBUG] Message {i+1}: From='{from_header}', Time={time_diff/1000:.1f}s after question")
-            print(f"[DEBUG] Message {i+1}: Target email='{config.TARGET_EMAIL}', Match={target_lower in from_lower}")
+            print(f"[DEBUG] Message {i+1}: Target email='{self.config.target_email}', Match={target_lower in from_lower}")
             
             # IMPORTANT: Only accept messages that are clearly from the user's email address
             # Reject messages that appear to be from the service account
@@ -332,68 +744,73 @@ class EmailService:
             # Check if it's from the user's email address
             # The email must contain the target email address
             if target_lower not in from_lower:
-                print(f"[DEBUG] Message {i+1}: Not from target email (from='{from_header}', target='{config.TARGET_EMAIL}'), skipping")
+                print(f"[DEBUG] Message {i+1}: Not from target email (from='{from_header}', target='{self.config.target_email}'), skipping")
                 continue
             
-            if target_lower in from_lower:
-                # Additional check: if the message was sent very recently (within 10 seconds of our question),
-                # it's likely an automated response, not a user response
-                # time_diff is already calculated above
-                if time_diff < 10000:  # Less than 10 seconds
-                    print(f"⚠️  Message too recent ({time_diff/1000:.1f}s), likely automated, skipping...")
-                    continue
-                
-                # Additional check: Look for common feedback patterns in the message
-                # If it contains "Score:" or "Feedback:" it's likely our feedback email
-                response_text_preview = self.extract_message_text(message)[:200].lower()
-                if any(keyword in response_text_preview for keyword in ['score:', 'your score:', 'feedback:', 'missing points:']):
-                    print(f"⚠️  Message appears to be feedback email, skipping...")
-                    continue
-                
-                # Accept messages from the user
-                # Note: We can't perfectly distinguish API-sent vs manually-sent emails,
-                # but the timestamp check, exclude list, and content checks should catch most cases
-                # Extract and check the text - make sure it's not just a quote of the question
-                response_text = self.extract_message_text(message)
-                
-                # Clean up the response text - remove email quote markers
-                # Remove common email quote patterns
-                import re
-                # Remove lines starting with ">" (email quotes)
-                response_text = re.sub(r'^>.*$', '', response_text, flags=re.MULTILINE)
-                # Remove "On ... wrote:" patterns
-                response_text = re.sub(r'On .+ wrote:.*$', '', response_text, flags=re.MULTILINE | re.DOTALL)
-                # Remove excessive whitespace
-                response_text = re.sub(r'\n\s*\n', '\n', response_text)
-                response_text = response_text.strip()
-                
-                # Basic validation: response must be meaningful
-                if len(response_text) < 3:
-                    print(f"[DEBUG] Message {i+1}: Response too short ({len(response_text)} chars), skipping")
+            # Additional check: if the message was sent very recently (within 10 seconds of our question),
+            # it's likely an automated response, not a user response
+            # time_diff is already calculated above
+            if time_diff < 10000:  # Less than 10 seconds
+                print(f"⚠️  Message too recent ({time_diff/1000:.1f}s), likely automated, skipping...")
+                continue
+            
+            candidates.append((i, message_id))
+        
+        if not candidates:
+            return None
+        
+        # Passed the cheap metadata checks - fetch all candidate bodies in one batch
+        full_messages = self._get_messages([message_id for _, message_id in candidates])
+        missing_ids = [message_id for _, message_id in candidates if message_id not in full_messages]
+        if missing_ids:
+            # Raise rather than skip, so check_for_response rewinds its watermarks
+            raise Exception(f"Could not fetch message bodies: {missing_ids}")
+        
+        # Second pass: content checks, in thread order so the first valid response wins
+        for i, message_id in candidates:
+            full_message = full_messages[message_id]
+            
+            # Additional check: Look for common feedback patterns in the message
+            # If a line starts with "Score:" or "Feedback:" it's likely our feedback email
+            message_text = self.extract_message_text(full_message)
+            response_text_preview = message_text[:200].lower()
+            if any(line.lstrip().startswith(_FEEDBACK_MARKERS) for line in response_text_preview.splitlines()[:10]):
+                print(f"⚠️  Message appears to be feedback email, skipping...")
+                continue
+            
+            # Accept messages from the user
+            # Note: We can't perfectly distinguish API-sent vs manually-sent emails,
+            # but the timestamp check, exclude list, and content checks should catch most cases
+            # Extract and check the text - make sure it's not just a quote of the question
+            response_text = message_text
+            
+            # Clean up the response text - remove email quote markers
+            # Remove common email quote patterns
+            # Remove lines starting with ">" (email quotes)
+            response_text = _QUOTE_LINE_RE.sub('', response_text)
+            # Remove "On ... wrote:" patterns
+            response_text = _ON_WROTE_RE.sub('', response_text)
+            # Remove excessive whitespace
+            response_text = _BLANK_LINES_RE.sub('\n', response_text)
+            response_text = response_text.strip()
+            
+            # Basic validation: response must be meaningful
+            if len(response_text) < 3:
+                print(f"[DEBUG] Message {i+1}: Response too short ({len(response_text)} chars), skipping")
+                continue
+            
+            # Don't accept responses that are just the question repeated
+            # (sometimes email clients quote the question)
+            if question_text:
+                # Check if response is mostly the question
+                overlap = _question_overlap(question_text, response_text)
+                threshold = 0.85 if fuzz is not None else 0.8
+                if overlap > threshold:  # High overlap suggests it's just a quote
+                    print(f"[DEBUG] Message {i+1}: Response is likely just a quote of the question (overlap: {overlap:.1%}), ignoring...")
                     continue
-                
-                # Don't accept responses that are just the question repeated
-                # (sometimes email clients quote the question)
-                question_snippet = None
-                if sent_message_id:
-                    try:
-                        sent_msg = self.service.users().messages().get(
-                            userId='me', id=sent_message_id
-                        ).execute()
-                        question_text = self.extract_message_text(sent_msg)
-                        if question_text and len(question_text) > 10:
-                            # Check if response is mostly the question
-                            question_words = set(question_text.lower().split()[:10])  # First 10 words
-                            response_words = set(response_text.lower().split())
-                            overlap = len(question_words & response_words) / max(len(question_words), 1)
-                            if overlap > 0.8:  # More than 80% overlap suggests it's just a quote
-                                print(f"[DEBUG] Message {i+1}: Response is likely just a quote of the question (overlap: {overlap:.1%}), ignoring...")
-                                continue
-                    except:
-                        pass
-                
-                # Return the first valid response found
-                print(f"[DEBUG] ✓ Valid response detected from message {i+1}: {response_text[:50]}...")
-                return response_text
+            
+            # Return the first valid response found
+            print(f"[DEBUG] ✓ Valid response detected from message {i+1}: {response_text[:50]}...")
+            return response_text
         
         return None
@@ -1,22 +1,255 @@
 """Gemini API service for grading quiz responses."""
-from typing import Dict, Optional
+import asyncio
+import functools
+import hashlib
 import os
-import google.generativeai as genai
-import config
+import random
+import re
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import orjson
+from config import get_config, load_json, save_json
+
+GEMINI_API_HOST = 'generativelanguage.googleapis.com'
+# Where the resolved model name is remembered between runs, and for how long
+MODEL_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'wtf_galaxy', 'model.json')
+MODEL_CACHE_MAX_AGE_SECONDS = 7 * 24 * 60 * 60
+# Review sheet chunk embeddings, reused while the sheet (and chunking/model) is unchanged
+REVIEW_EMBED_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'wtf_galaxy', 'review_sheet_embeddings.npz')
+# Cached grades older than this are ignored and regenerated
+GRADE_CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+# Number of grading replies kept in memory (expired on-disk rows are purged at startup)
+GRADE_CACHE_MEMORY_SIZE = 4096
+# Embedding model and cosine-similarity cutoff for reusing a near-duplicate answer's grade
+# (only when SEMANTIC_GRADE_CACHE is on). Kept very high: a corrected retry of a question is
+# often phrased almost like the earlier wrong answer and must be graded afresh
+SEMANTIC_CACHE_MODEL = 'models/text-embedding-004'
+SEMANTIC_CACHE_THRESHOLD = 0.98
+# Maximum number of responses graded together in one grade_responses() call
+GRADE_BATCH_SIZE = 20
+# Maximum concurrent Gemini calls in grade_many()
+GRADE_MAX_CONCURRENCY = 16
+# Attempts per Gemini call on rate-limit/server errors, and the first backoff delay
+GRADE_MAX_ATTEMPTS = 5
+GRADE_RETRY_BASE_DELAY_SECONDS = 1
+
+# Sampling settings for grading; a low temperature keeps scores consistent. The output
+# cap bounds worst-case latency but must leave room for long feedback (a JSON reply cut
+# off mid-string doesn't parse) and, on thinking models, for the thinking tokens too
+GRADE_TEMPERATURE = 0.2
+GRADE_MAX_OUTPUT_TOKENS = 2048
+GRADE_BATCH_MAX_OUTPUT_TOKENS = 8192  # Whole batch reply; common model output limit
+
+# Review sheet retrieval: chunk size, chunks per question, and texts per embedding call
+REVIEW_CHUNK_MAX_CHARS = 1000
+REVIEW_CONTEXT_TOP_K = 5
+EMBED_BATCH_SIZE = 100
+
+# Response schemas for Gemini's JSON mode, so replies parse without any cleanup
+GRADE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'score': {'type': 'integer'},
+        'feedback': {'type': 'string'},
+        'missing_points': {'type': 'array', 'items': {'type': 'string'}},
+    },
+    'required': ['score', 'feedback', 'missing_points'],
+}
+BATCH_GRADE_SCHEMA = {
+    'type': 'array',
+    'items': {
+        'type': 'object',
+        'properties': {'id': {'type': 'integer'}, **GRADE_SCHEMA['properties']},
+        'required': ['id'] + GRADE_SCHEMA['required'],
+    },
+}
+
+# Static prompt skeletons; only the per-request slots are filled in at grading time.
+# Everything before the user's response is identical for every answer to a question,
+# so Gemini's implicit prompt caching can reuse that prefix across students.
+_PROMPT_TEMPLATE = """You are a helpful quiz grader evaluating a student's response for a galaxies/astronomy course. Use the review sheet context provided to give accurate, contextually relevant feedback.
+
+Please provide:
+1. A score from 0-100 based on how well the user's response matches the correct answer
+2. Specific feedback on what the user got right, referencing concepts from the review sheet when relevant
+3. What key points or information the user is missing (if any), and suggest specific sections from the review sheet they should review
+
+Format your response as JSON with the following structure:
+{{
+    "score": <number 0-100>,
+    "feedback": "<overall feedback>",
+    "missing_points": ["<point 1>", "<point 2>", ...]
+}}
+
+Be fair but thorough. If the user's response captures the essence of the answer even if worded differently, give appropriate credit. Only mark points as missing if they are genuinely absent or incorrect. When providing feedback, reference specific concepts, equations, or sections from the review sheet that are relevant to the question.
+{context_section}
+Question: {question}
+
+Correct Answer: {correct_answer}
+
+User's Response: {user_response}"""
+
+_BATCH_PROMPT_TEMPLATE = """You are a helpful quiz grader evaluating students' responses for a galaxies/astronomy course. Use the review sheet context provided to give accurate, contextually relevant feedback.
+{context_section}
+Grade each of the following items. Each item has an "id", the "question", the "correct_answer", and the user's "response":
+
+{items}
+
+For each item provide:
+1. A score from 0-100 based on how well the user's response matches the correct answer
+2. Specific feedback on what the user got right, referencing concepts from the review sheet when relevant
+3. What key points or information the user is missing (if any), and suggest specific sections from the review sheet they should review
+
+Format your response as a JSON array with one object per item:
+[
+    {{
+        "id": <item id>,
+        "score": <number 0-100>,
+        "feedback": "<overall feedback>",
+        "missing_points": ["<point 1>", "<point 2>", ...]
+    }},
+    ...
+]
+
+Be fair but thorough. If the user's response captures the essence of the answer even if worded differently, give appropriate credit. Only mark points as missing if they are genuinely absent or incorrect. When providing feedback, reference specific concepts, equations, or sections from the review sheet that are relevant to the question."""
+
+# Punctuation stripped before checking whether an answer is empty
+_PUNCTUATION_RE = re.compile(r'[^\w\s]+')
+
+# Outermost JSON object/array in a reply that isn't bare JSON (e.g. wrapped in markdown fences)
+_JSON_RE = re.compile(r'[\[{].*[\]}]', re.DOTALL)
+
+# Divider around the correct answer in feedback emails
+_SEP = "=" * 60
+
+
+@functools.lru_cache(maxsize=4)
+def _load_sheet_cached(path: str, mtime: float) -> str:
+    """Read a review sheet once per process; mtime is part of the key so edits are picked up."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+class _RateLimiter:
+    """Spaces calls evenly so at most `per_minute` start in any minute (thread-safe)."""
+    
+    def __init__(self, per_minute: int):
+        self._interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+    
+    def reserve(self) -> float:
+        """Claim the next free slot and return how many seconds to wait for it."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+            return slot - now
 
 
 class GradingService:
     """Handles grading of quiz responses using Gemini API."""
     
     def __init__(self):
-        if not config.GEMINI_API_KEY:
+        self.config = get_config()
+        if not self.config.gemini_api_key:
             raise ValueError("GEMINI_API_KEY is required in .env file")
         
-        genai.configure(api_key=config.GEMINI_API_KEY)
+        # Imported here rather than at module top: the SDK pulls in grpc/protobuf,
+        # which would slow down every import of this module
+        global genai
+        import google.generativeai as genai
+        from google.api_core import exceptions as api_exceptions
+        
+        # Rate limits (429) and server errors (5xx) are worth retrying; bad requests (400) are not
+        self._retryable_errors = (api_exceptions.TooManyRequests, api_exceptions.ServerError)
+        # What Gemini raises for a model name it no longer serves, e.g. a retired model (404);
+        # 400s like prompt-too-long aren't included, since a new model wouldn't fix them
+        self._model_errors = (api_exceptions.NotFound,)
+        self._rate_limiter = _RateLimiter(self.config.gemini_requests_per_minute)
+        
+        # The SDK caches one client per service for the whole process; with the
+        # default gRPC transport that's a single persistent HTTP/2 channel, so
+        # every generate_content call reuses the same warm connection
+        genai.configure(api_key=self.config.gemini_api_key, transport=self.config.gemini_transport)
+        
+        # Generation settings are identical for every call, so build them once
+        self._gen_config = genai.types.GenerationConfig(
+            response_mime_type='application/json',
+            response_schema=GRADE_SCHEMA,
+            temperature=GRADE_TEMPERATURE,
+            max_output_tokens=GRADE_MAX_OUTPUT_TOKENS
+        )
+        self._batch_gen_config = genai.types.GenerationConfig(
+            response_mime_type='application/json',
+            response_schema=BATCH_GRADE_SCHEMA,
+            temperature=GRADE_TEMPERATURE,
+            max_output_tokens=GRADE_BATCH_MAX_OUTPUT_TOKENS
+        )
         
         # Load review sheet context if available
         self.review_sheet_context = self._load_review_sheet()
+        # Fallback when retrieval is unavailable: keep last 8000 chars for most recent/relevant content
+        self._context_section = self._build_context_section((self.review_sheet_context or '')[-8000:])
+        self._index_review_sheet()
+        
+        # Raw model replies keyed by a hash of (model, context, question, answer, response)
+        self._review_sheet_digest = hashlib.blake2b(
+            (self.review_sheet_context or '').encode('utf-8'), digest_size=8
+        ).hexdigest()
+        self._grade_cache = OrderedDict()
+        # Guards both the in-memory LRU and the sqlite connection (used from worker threads)
+        self._grade_cache_lock = threading.Lock()
+        self._grade_cache_db = self._open_grade_cache()
+        # {question_key: (unit-norm embeddings matrix, [grade result per row])}
+        self._semantic_cache = {}
+        
+        # Reuse the model picked on a previous run; list_models() is a slow RPC
+        cached_model = self._load_cached_model_name()
+        self._model_from_cache = bool(cached_model)  # Rediscover once if Gemini rejects it
+        if cached_model:
+            self.model = genai.GenerativeModel(cached_model)
+            print(f"✓ Using cached Gemini model: {cached_model}")
+        else:
+            used_model = self._discover_model()
+            if used_model:
+                self._save_cached_model_name(used_model)
+        
+        # Open the generation connection in the background so the first grade is fast
+        threading.Thread(target=self._prewarm_connection, daemon=True).start()
+    
+    def _load_cached_model_name(self) -> Optional[str]:
+        """Get the model name saved by a recent run, if it's still fresh."""
+        if not os.path.exists(MODEL_CACHE_FILE):
+            return None
+        try:
+            cached = load_json(MODEL_CACHE_FILE)
+            if time.time() - cached['ts'] < MODEL_CACHE_MAX_AGE_SECONDS:
+                return cached['model']
+        except Exception as e:
+            print(f"Warning: Could not read model cache: {e}")
+        return None
+    
+    def _save_cached_model_name(self, model_name: str):
+        """Remember the resolved model name for future runs."""
+        try:
+            os.makedirs(os.path.dirname(MODEL_CACHE_FILE), exist_ok=True)
+            save_json(MODEL_CACHE_FILE, {'model': model_name, 'ts': time.time()})
+        except OSError as e:
+            print(f"Warning: Could not write model cache: {e}")
+    
+    def _discover_model(self) -> Optional[str]:
+        """
+        Pick the cheapest available Gemini model and set self.model.
         
+        Returns:
+            The chosen model name if it came from list_models(), else None
+        """
         # First, list available models to see what we can use
         print("Checking available Gemini models...")
         try:
@@ -27,9 +260,6 @@ class GradingService:
             ]
             print(f"Available models: {available_models}")
             
-            # Extract just the model name (remove 'models/' prefix if present)
-            model_names_clean = [m.replace('models/', '') for m in available_models]
-            
             # Try preferred models in order (cheapest first)
             # Order: lite (cheapest) -> flash -> pro (most expensive)
             preferred_models = [
@@ -45,82 +275,318 @@ class GradingService:
                 'gemini-1.5-pro',
                 'gemini-pro'
             ]
-            self.model = None
-            used_model = None
             
-            for preferred in preferred_models:
-                # Try to find a matching model in the available list
-                for available_full_name in available_models:
-                    # Check if this available model matches our preferred model
-                    available_clean = available_full_name.replace('models/', '')
-                    if preferred in available_clean or available_clean.endswith(preferred):
-                        try:
-                            self.model = genai.GenerativeModel(available_full_name)
-                            used_model = available_full_name
-                            print(f"✓ Using Gemini model: {used_model}")
-                            break
-                        except Exception as e:
-                            # Try without 'models/' prefix
-                            try:
-                                self.model = genai.GenerativeModel(available_clean)
-                                used_model = available_clean
-                                print(f"✓ Using Gemini model: {used_model}")
-                                break
-                            except:
-                                continue
-                if self.model:
-                    break
+            # Map each name without its 'models/' prefix back to the full name
+            cleaned = {m.replace('models/', ''): m for m in available_models}
+            used_model = next(
+                (full_name for preferred in preferred_models
+                 for clean_name, full_name in cleaned.items() if preferred in clean_name),
+                None
+            )
             
-            # If no preferred model worked, try the first available model
-            if self.model is None and available_models:
-                try:
-                    self.model = genai.GenerativeModel(available_models[0])
-                    used_model = available_models[0]
-                    print(f"✓ Using first available Gemini model: {used_model}")
-                except Exception as e:
-                    pass
+            # If no preferred model is available, use the first available model
+            if used_model is None and available_models:
+                used_model = available_models[0]
+                print("No preferred Gemini model available, using the first one listed")
             
-            if self.model is None:
+            if used_model is None:
                 raise ValueError(
                     f"Could not initialize any Gemini model.\n"
                     f"Available models: {available_models}\n"
                     "Please check your API key and model availability."
                 )
+            
+            # GenerativeModel() just records the name; it doesn't contact the server
+            self.model = genai.GenerativeModel(used_model)
+            print(f"✓ Using Gemini model: {used_model}")
+            return used_model
                 
         except Exception as e:
-            # Fallback: try common model names
+            # Fallback: use a common model name
             print(f"Warning: Could not list models: {e}")
-            print("Trying common model names...")
-            model_names = ['gemini-1.5-pro', 'gemini-1.5-flash', 'gemini-pro']
-            self.model = None
-            
-            for model_name in model_names:
-                try:
-                    self.model = genai.GenerativeModel(model_name)
-                    print(f"✓ Using Gemini model: {model_name}")
-                    break
-                except Exception:
-                    continue
-            
-            if self.model is None:
-                raise ValueError(
-                    f"Could not initialize Gemini model. Tried: {model_names}\n"
-                    "Please check your API key and ensure you have access to Gemini models."
-                )
+            print("Falling back to a common model name...")
+            model_name = 'gemini-1.5-pro'
+            self.model = genai.GenerativeModel(model_name)
+            print(f"✓ Using Gemini model: {model_name}")
+            return None  # Guessed name, not worth caching
+    
+    def _prewarm_connection(self):
+        """Resolve DNS and open the generation channel before the first real request."""
+        try:
+            socket.getaddrinfo(GEMINI_API_HOST, 443)
+            # count_tokens is a cheap RPC on the same client generate_content uses
+            self.model.count_tokens("ping")
+        except Exception:
+            pass  # Warmup is best-effort; the first real call will connect itself
     
     def _load_review_sheet(self) -> Optional[str]:
         """Load review sheet context if available."""
-        if os.path.exists(config.REVIEW_SHEET):
+        if os.path.exists(self.config.review_sheet):
             try:
-                with open(config.REVIEW_SHEET, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    print(f"✓ Loaded review sheet context ({len(content)} characters)")
-                    return content
+                content = _load_sheet_cached(self.config.review_sheet, os.path.getmtime(self.config.review_sheet))
+                print(f"✓ Loaded review sheet context ({len(content)} characters)")
+                return content
             except Exception as e:
                 print(f"Warning: Could not load review sheet: {e}")
                 return None
         return None
     
+    def _open_grade_cache(self) -> Optional[sqlite3.Connection]:
+        """Open (and create if needed) the persistent grade cache."""
+        try:
+            # Shared with grade_response_async's worker threads; access is serialized by _grade_cache_lock
+            conn = sqlite3.connect(self.config.grade_cache_file, check_same_thread=False)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS grade_cache "
+                "(key TEXT PRIMARY KEY, response TEXT NOT NULL, ts INTEGER NOT NULL)"
+            )
+            # Expired rows are never read again; drop them so the file doesn't grow forever
+            conn.execute(
+                "DELETE FROM grade_cache WHERE ts < ?",
+                (int(time.time()) - GRADE_CACHE_TTL_SECONDS,)
+            )
+            conn.commit()
+            return conn
+        except sqlite3.Error as e:
+            print(f"Warning: Could not open grade cache: {e}")
+            return None
+    
+    def _grade_cache_key(self, question: str, correct_answer: str, user_response: str) -> str:
+        """Stable hash of everything that determines the model's grading reply."""
+        model_name = getattr(self.model, 'model_name', '')
+        payload = f"{model_name}|{self._review_sheet_digest}|{question}|{correct_answer}|{user_response}"
+        return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+    
+    def _get_cached_response(self, key: str) -> Optional[str]:
+        """Look up a raw model reply in the memory cache, then the on-disk cache."""
+        with self._grade_cache_lock:
+            cached = self._grade_cache.get(key)
+            if cached is not None:
+                self._grade_cache.move_to_end(key)
+                return cached
+        
+        if self._grade_cache_db is None:
+            return None
+        try:
+            with self._grade_cache_lock:
+                row = self._grade_cache_db.execute(
+                    "SELECT response FROM grade_cache WHERE key = ? AND ts >= ?",
+                    (key, int(time.time()) - GRADE_CACHE_TTL_SECONDS)
+                ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Warning: Could not read grade cache: {e}")
+            return None
+        if row is None:
+            return None
+        
+        self._remember_response(key, row[0])
+        return row[0]
+    
+    def _store_cached_response(self, key: str, response_text: str):
+        """Save a raw model reply to the memory and on-disk caches."""
+        self._remember_response(key, response_text)
+        if self._grade_cache_db is None:
+            return
+        try:
+            with self._grade_cache_lock:
+                self._grade_cache_db.execute(
+                    "INSERT OR REPLACE INTO grade_cache (key, response, ts) VALUES (?, ?, ?)",
+                    (key, response_text, int(time.time()))
+                )
+                self._grade_cache_db.commit()
+        except sqlite3.Error as e:
+            print(f"Warning: Could not write grade cache: {e}")
+    
+    def _remember_response(self, key: str, response_text: str):
+        """Add a reply to the bounded in-memory LRU."""
+        with self._grade_cache_lock:
+            self._grade_cache[key] = response_text
+            self._grade_cache.move_to_end(key)
+            if len(self._grade_cache) > GRADE_CACHE_MEMORY_SIZE:
+                self._grade_cache.popitem(last=False)
+    
+    def _embed_content(self, content, task_type: Optional[str] = None) -> Dict:
+        """
+        Call embed_content through the rate limiter, retrying rate-limit and server errors.
+        
+        Args:
+            content: A text or a list of texts to embed
+            task_type: Optional embedding task type (e.g. 'retrieval_document')
+        
+        Returns:
+            The embed_content result (raises the last error once all attempts fail)
+        """
+        kwargs = {'model': SEMANTIC_CACHE_MODEL, 'content': content}
+        if task_type:
+            kwargs['task_type'] = task_type
+        for attempt in range(GRADE_MAX_ATTEMPTS):
+            time.sleep(self._rate_limiter.reserve())
+            try:
+                return genai.embed_content(**kwargs)
+            except self._retryable_errors as e:
+                if attempt == GRADE_MAX_ATTEMPTS - 1:
+                    raise
+                delay = self._retry_delay(attempt)
+                print(f"⚠️  Gemini embedding call failed ({e}), retrying in {delay:.1f}s...")
+                time.sleep(delay)
+    
+    def _embed(self, text: str) -> Optional[np.ndarray]:
+        """Embed text as an L2-normalized vector, or None if embedding fails."""
+        try:
+            result = self._embed_content(text)
+        except Exception as e:
+            print(f"Warning: Could not embed response for semantic cache: {e}")
+            return None
+        vec = np.asarray(result['embedding'], dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else None
+    
+    def _semantic_lookup(self, question_key: str, vec: Optional[np.ndarray]) -> Optional[Dict]:
+        """Return the grade of the most similar cached answer if it's close enough."""
+        entry = self._semantic_cache.get(question_key)
+        if entry is None or vec is None:
+            return None
+        vectors, results = entry
+        # One vectorized dot product gives cosine similarity against every cached answer
+        sims = vectors @ vec
+        best = int(np.argmax(sims))
+        if sims[best] >= SEMANTIC_CACHE_THRESHOLD:
+            print(f"✓ Reusing grade from a near-duplicate answer (similarity: {sims[best]:.3f})")
+            return dict(results[best])
+        return None
+    
+    def _semantic_store(self, question_key: str, vec: Optional[np.ndarray], result: Dict):
+        """Remember a grade under the answer's embedding."""
+        if vec is None:
+            return
+        if question_key in self._semantic_cache:
+            vectors, results = self._semantic_cache[question_key]
+            self._semantic_cache[question_key] = (np.vstack([vectors, vec]), results + [dict(result)])
+        else:
+            self._semantic_cache[question_key] = (vec[np.newaxis, :], [dict(result)])
+    
+    def _split_review_sheet(self, text: str) -> List[str]:
+        """Split the review sheet into paragraphs, breaking long ones at line boundaries."""
+        chunks = []
+        for paragraph in text.split('\n\n'):
+            current = ''
+            for line in paragraph.strip().splitlines():
+                if current and len(current) + len(line) + 1 > REVIEW_CHUNK_MAX_CHARS:
+                    chunks.append(current)
+                    current = line
+                else:
+                    current = f"{current}\n{line}" if current else line
+            if current.strip():
+                chunks.append(current)
+        return chunks
+    
+    def _index_review_sheet(self):
+        """Embed the review sheet chunks once so prompts can include just the relevant ones."""
+        self._chunks: List[str] = []
+        self._chunk_emb: Optional[np.ndarray] = None
+        self._question_chunk_ids: Dict[str, List[int]] = {}
+        if not self.review_sheet_context:
+            return
+        
+        chunks = self._split_review_sheet(self.review_sheet_context)
+        digest = hashlib.blake2b(
+            f"{SEMANTIC_CACHE_MODEL}|{REVIEW_CHUNK_MAX_CHARS}|{self.review_sheet_context}".encode('utf-8'),
+            digest_size=16
+        ).hexdigest()
+        
+        # Reuse the embeddings from a previous run if the sheet hasn't changed
+        cached = self._load_review_embeddings(digest, len(chunks))
+        if cached is not None:
+            self._chunks = chunks
+            self._chunk_emb = cached
+            print(f"✓ Loaded review sheet index from cache ({len(chunks)} chunks)")
+            return
+        
+        vectors = []
+        try:
+            for start in range(0, len(chunks), EMBED_BATCH_SIZE):
+                result = self._embed_content(chunks[start:start + EMBED_BATCH_SIZE], task_type='retrieval_document')
+                vectors.extend(result['embedding'])
+        except Exception as e:
+            print(f"Warning: Could not index review sheet, using its last 8000 characters: {e}")
+            return
+        
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self._chunks = chunks
+        self._chunk_emb = matrix / norms
+        self._save_review_embeddings(digest, self._chunk_emb)
+        print(f"✓ Indexed review sheet ({len(chunks)} chunks)")
+    
+    def _load_review_embeddings(self, digest: str, num_chunks: int) -> Optional[np.ndarray]:
+        """Get the cached chunk embeddings if they were made from this exact review sheet."""
+        if not os.path.exists(REVIEW_EMBED_CACHE_FILE):
+            return None
+        try:
+            with np.load(REVIEW_EMBED_CACHE_FILE, allow_pickle=False) as cached:
+                if str(cached['digest']) == digest and cached['embeddings'].shape[0] == num_chunks:
+                    return cached['embeddings']
+        except Exception as e:
+            print(f"Warning: Could not read review sheet index cache: {e}")
+        return None
+    
+    def _save_review_embeddings(self, digest: str, embeddings: np.ndarray):
+        """Atomically write the chunk embeddings, tagged with the review sheet digest."""
+        tmp_path = REVIEW_EMBED_CACHE_FILE + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(REVIEW_EMBED_CACHE_FILE), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, digest=np.array(digest), embeddings=embeddings)
+            os.replace(tmp_path, REVIEW_EMBED_CACHE_FILE)
+        except OSError as e:
+            print(f"Warning: Could not write review sheet index cache: {e}")
+    
+    def _relevant_chunk_ids(self, question: str) -> List[int]:
+        """Indices of the review sheet chunks most similar to the question, in document order."""
+        if question in self._question_chunk_ids:
+            return self._question_chunk_ids[question]
+        try:
+            result = self._embed_content(question, task_type='retrieval_query')
+        except Exception as e:
+            print(f"Warning: Could not embed question for review sheet lookup: {e}")
+            return []
+        
+        vec = np.asarray(result['embedding'], dtype=np.float32)
+        sims = self._chunk_emb @ vec  # Norm of vec doesn't change the ranking
+        top = np.argsort(sims)[::-1][:REVIEW_CONTEXT_TOP_K]
+        chunk_ids = sorted(int(i) for i in top)
+        self._question_chunk_ids[question] = chunk_ids
+        return chunk_ids
+    
+    def _context_for(self, questions: List[str]) -> str:
+        """Build the review sheet section from the chunks relevant to the given questions."""
+        if self._chunk_emb is None:
+            return self._context_section
+        chunk_ids = sorted({i for question in questions for i in self._relevant_chunk_ids(question)})
+        if not chunk_ids:
+            return self._context_section
+        return self._build_context_section('\n\n'.join(self._chunks[i] for i in chunk_ids))
+    
+    def _build_context_section(self, context_text: str) -> str:
+        """Wrap review sheet text in the section shared by all grading prompts."""
+        if not context_text:
+            return ""
+        return f"""
+
+REVIEW SHEET CONTEXT (for reference):
+{context_text}
+"""
+    
+    def _build_prompt(self, user_response: str, correct_answer: str, question: str) -> str:
+        """Build the grading prompt for a single response."""
+        return _PROMPT_TEMPLATE.format(
+            question=question,
+            correct_answer=correct_answer,
+            user_response=user_response,
+            context_section=self._context_for([question]),
+        )
+    
     def grade_response(self, user_response: str, correct_answer: str, question: str) -> Dict:
         """
         Grade a user's response against the correct answer.
@@ -133,70 +599,295 @@ class GradingService:
         Returns:
             Dict with 'score' (0-100), 'feedback', and 'missing_points'
         """
-        # Build context section if review sheet is available
-        context_section = ""
-        if self.review_sheet_context:
-            # Limit context to avoid token limits (keep last 8000 chars for most recent/relevant content)
-            context_text = self.review_sheet_context[-8000:] if len(self.review_sheet_context) > 8000 else self.review_sheet_context
-            context_section = f"""
-
-REVIEW SHEET CONTEXT (for reference):
-{context_text}
-"""
+        empty = self._grade_if_empty(user_response, correct_answer)
+        if empty is not None:
+            return empty
         
-        prompt = f"""You are a helpful quiz grader evaluating a student's response for a galaxies/astronomy course. Use the review sheet context provided to give accurate, contextually relevant feedback.
-
-Question: {question}
-
-Correct Answer: {correct_answer}
-
-User's Response: {user_response}
-{context_section}
-Please provide:
-1. A score from 0-100 based on how well the user's response matches the correct answer
-2. Specific feedback on what the user got right, referencing concepts from the review sheet when relevant
-3. What key points or information the user is missing (if any), and suggest specific sections from the review sheet they should review
-
-Format your response as JSON with the following structure:
-{{
-    "score": <number 0-100>,
-    "feedback": "<overall feedback>",
-    "missing_points": ["<point 1>", "<point 2>", ...]
-}}
-
-Be fair but thorough. If the user's response captures the essence of the answer even if worded differently, give appropriate credit. Only mark points as missing if they are genuinely absent or incorrect. When providing feedback, reference specific concepts, equations, or sections from the review sheet that are relevant to the question."""
-
         try:
-            response = self.model.generate_content(prompt)
-            response_text = response.text.strip()
-            
-            # Try to extract JSON from the response
-            # Sometimes Gemini wraps JSON in markdown code blocks
-            if "```json" in response_text:
-                response_text = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text:
-                response_text = response_text.split("```")[1].split("```")[0].strip()
+            cache_key, cached_text, question_key, response_vec, similar = self._check_grade_caches(
+                user_response, correct_answer, question
+            )
+            if similar is not None:
+                return similar
             
-            import json
-            result = json.loads(response_text)
+            response_text = cached_text
+            if response_text is None:
+                prompt = self._build_prompt(user_response, correct_answer, question)
+                response_text = self._generate_text(prompt, self._gen_config)
+            return self._finish_grade(response_text, cached_text, cache_key, question_key, response_vec)
             
-            # Validate structure
-            if 'score' not in result:
-                result['score'] = 50  # Default score if parsing fails
-            if 'feedback' not in result:
-                result['feedback'] = "Unable to generate detailed feedback."
-            if 'missing_points' not in result:
-                result['missing_points'] = []
+        except Exception as e:
+            return self._grading_error_result(e)
+    
+    async def grade_response_async(self, user_response: str, correct_answer: str, question: str) -> Dict:
+        """
+        Async version of grade_response(), so many responses can be graded concurrently.
+        
+        Args:
+            user_response: The user's answer text
+            correct_answer: The known correct answer
+            question: The original question (for context)
+        
+        Returns:
+            Dict with 'score' (0-100), 'feedback', and 'missing_points'
+        """
+        # Cache lookups may embed the response (a blocking call), so run them off the loop
+        empty = self._grade_if_empty(user_response, correct_answer)
+        if empty is not None:
+            return empty
+        
+        try:
+            cache_key, cached_text, question_key, response_vec, similar = await asyncio.to_thread(
+                self._check_grade_caches, user_response, correct_answer, question
+            )
+            if similar is not None:
+                return similar
             
-            return result
+            response_text = cached_text
+            if response_text is None:
+                # Building the prompt may embed the question, so keep that off the loop too
+                prompt = await asyncio.to_thread(self._build_prompt, user_response, correct_answer, question)
+                response_text = await self._generate_text_async(prompt, self._gen_config)
+            return self._finish_grade(response_text, cached_text, cache_key, question_key, response_vec)
             
         except Exception as e:
-            # Fallback if API call fails
-            return {
-                'score': 50,
-                'feedback': f"Error grading response: {str(e)}. Please try again.",
-                'missing_points': []
-            }
+            return self._grading_error_result(e)
+    
+    async def grade_many(self, items: List[Tuple[str, str, str]]) -> List[Dict]:
+        """
+        Grade many responses concurrently, capped at GRADE_MAX_CONCURRENCY in flight.
+        
+        Args:
+            items: List of (user_response, correct_answer, question) tuples
+        
+        Returns:
+            List of grade dicts, in input order
+        """
+        semaphore = asyncio.Semaphore(GRADE_MAX_CONCURRENCY)  # Stay under the RPM limit
+        
+        async def grade_one(item):
+            async with semaphore:
+                return await self.grade_response_async(*item)
+        
+        return await asyncio.gather(*(grade_one(item) for item in items))
+    
+    def _generate_text(self, prompt: str, generation_config) -> str:
+        """
+        Call Gemini for a JSON reply, retrying rate-limit and server errors with backoff.
+        
+        Args:
+            prompt: The full grading prompt
+            generation_config: GenerationConfig with the response schema to use
+        
+        Returns:
+            The raw reply text (raises the last error once all attempts fail)
+        """
+        model = self.model
+        for attempt in range(GRADE_MAX_ATTEMPTS):
+            time.sleep(self._rate_limiter.reserve())
+            try:
+                response = model.generate_content(prompt, generation_config=generation_config, stream=True)
+                # Receive the reply in chunks as it's generated instead of waiting for all of it
+                return "".join(chunk.text for chunk in response)
+            except self._model_errors as e:
+                if not self._replace_rejected_model(model, e):
+                    raise
+                return self._generate_text(prompt, generation_config)
+            except self._retryable_errors as e:
+                if attempt == GRADE_MAX_ATTEMPTS - 1:
+                    raise
+                delay = self._retry_delay(attempt)
+                print(f"⚠️  Gemini call failed ({e}), retrying in {delay:.1f}s...")
+                time.sleep(delay)
+    
+    async def _generate_text_async(self, prompt: str, generation_config) -> str:
+        """Async version of _generate_text()."""
+        model = self.model
+        for attempt in range(GRADE_MAX_ATTEMPTS):
+            await asyncio.sleep(self._rate_limiter.reserve())
+            try:
+                response = await model.generate_content_async(
+                    prompt, generation_config=generation_config, stream=True
+                )
+                return "".join([chunk.text async for chunk in response])
+            except self._model_errors as e:
+                # Called inline (not in a thread) so concurrent calls can't both rediscover
+                if not self._replace_rejected_model(model, e):
+                    raise
+                return await self._generate_text_async(prompt, generation_config)
+            except self._retryable_errors as e:
+                if attempt == GRADE_MAX_ATTEMPTS - 1:
+                    raise
+                delay = self._retry_delay(attempt)
+                print(f"⚠️  Gemini call failed ({e}), retrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+    
+    def _replace_rejected_model(self, model, error: Exception) -> bool:
+        """
+        Handle Gemini rejecting a model: drop the cached name and pick a model again, once.
+        
+        Args:
+            model: The GenerativeModel the failed call used
+            error: The NotFound error it raised
+        
+        Returns:
+            True if the call should be retried with self.model
+        """
+        if self.model is not model:
+            return True  # Another call already replaced it
+        if not self._model_from_cache:
+            return False  # A freshly discovered model failing isn't a stale-cache problem
+        self._model_from_cache = False
+        
+        print(f"⚠️  Cached Gemini model was rejected ({error}), checking available models again...")
+        try:
+            os.remove(MODEL_CACHE_FILE)
+        except OSError:
+            pass
+        used_model = self._discover_model()
+        if used_model:
+            self._save_cached_model_name(used_model)
+        return True
+    
+    def _retry_delay(self, attempt: int) -> float:
+        """Exponential backoff with jitter, so concurrent retries don't line up."""
+        return GRADE_RETRY_BASE_DELAY_SECONDS * 2 ** attempt + random.random()
+    
+    def _grade_if_empty(self, user_response: str, correct_answer: str) -> Optional[Dict]:
+        """Grade a blank or punctuation-only response locally, without calling the API."""
+        if _PUNCTUATION_RE.sub('', user_response or '').strip():
+            return None
+        return {
+            'score': 0,
+            'feedback': "No answer provided.",
+            'missing_points': [correct_answer]
+        }
+    
+    def _check_grade_caches(self, user_response: str, correct_answer: str, question: str) -> Tuple:
+        """
+        Look up a grade in the exact cache, then the semantic cache.
+        
+        Returns:
+            Tuple of (cache_key, cached_text, question_key, response_vec, similar_result);
+            similar_result is a ready grade dict on a semantic hit, otherwise None
+        """
+        cache_key = self._grade_cache_key(question, correct_answer, user_response)
+        cached_text = self._get_cached_response(cache_key)
+        
+        # On an exact-cache miss, try a paraphrase of an answer we've already graded
+        question_key = None
+        response_vec = None
+        similar = None
+        if cached_text is None and self.config.semantic_grade_cache:
+            question_key = self._grade_cache_key(question, correct_answer, '')
+            response_vec = self._embed(user_response)
+            similar = self._semantic_lookup(question_key, response_vec)
+        return cache_key, cached_text, question_key, response_vec, similar
+    
+    def _finish_grade(self, response_text: str, cached_text: Optional[str], cache_key: str,
+                      question_key: Optional[str], response_vec: Optional[np.ndarray]) -> Dict:
+        """Parse a model reply and, if it came from the API, add it to the caches."""
+        result = self._parse_json_reply(response_text)
+        
+        # Only cache responses that parsed, so a bad reply is retried next time
+        if cached_text is None:
+            self._store_cached_response(cache_key, response_text)
+            self._semantic_store(question_key, response_vec, result)
+        
+        return result
+    
+    def _grading_error_result(self, error: Exception) -> Dict:
+        """Fallback grade when the API call or parsing fails."""
+        return {
+            'score': 50,
+            'feedback': f"Error grading response: {str(error)}. Please try again.",
+            'missing_points': []
+        }
+    
+    def grade_responses(self, items: List[Tuple[str, str, str]]) -> List[Dict]:
+        """
+        Grade several responses, sharing one Gemini call per batch.
+        
+        Args:
+            items: List of (user_response, correct_answer, question) tuples
+        
+        Returns:
+            List of grade dicts (same shape as grade_response), in input order
+        """
+        results: List[Optional[Dict]] = [None] * len(items)
+        
+        # Exact-cache hits don't need to go to the model at all
+        pending = []
+        for i, (user_response, correct_answer, question) in enumerate(items):
+            results[i] = self._grade_if_empty(user_response, correct_answer)
+            if results[i] is not None:
+                continue
+            cache_key = self._grade_cache_key(question, correct_answer, user_response)
+            cached_text = self._get_cached_response(cache_key)
+            if cached_text is not None:
+                try:
+                    results[i] = self._parse_json_reply(cached_text)
+                    continue
+                except (ValueError, TypeError):
+                    pass
+            pending.append((i, cache_key))
+        
+        for start in range(0, len(pending), GRADE_BATCH_SIZE):
+            chunk = pending[start:start + GRADE_BATCH_SIZE]
+            graded = self._grade_batch([(i, items[i]) for i, _ in chunk])
+            for i, cache_key in chunk:
+                if i in graded:
+                    results[i] = graded[i]
+                    self._store_cached_response(cache_key, orjson.dumps(graded[i]).decode('utf-8'))
+                else:
+                    # Batch reply missing or invalid for this item: grade it on its own
+                    results[i] = self.grade_response(*items[i])
+        
+        return results
+    
+    def _grade_batch(self, batch: List[Tuple[int, Tuple[str, str, str]]]) -> Dict[int, Dict]:
+        """
+        Grade a batch of (id, (user_response, correct_answer, question)) in one call.
+        
+        Returns:
+            Dict of id -> grade dict for every item the model graded validly
+        """
+        batch_items = [
+            {'id': item_id, 'question': question, 'correct_answer': correct_answer, 'response': user_response}
+            for item_id, (user_response, correct_answer, question) in batch
+        ]
+        prompt = _BATCH_PROMPT_TEMPLATE.format(
+            context_section=self._context_for([question for _, (_, _, question) in batch]),
+            items=orjson.dumps(batch_items, option=orjson.OPT_INDENT_2).decode('utf-8'),
+        )
+        
+        try:
+            parsed = self._parse_json_reply(self._generate_text(prompt, self._batch_gen_config))
+        except Exception as e:
+            print(f"Warning: Batch grading failed, grading individually: {e}")
+            return {}
+        
+        if not isinstance(parsed, list):
+            return {}
+        
+        expected_ids = {item_id for item_id, _ in batch}
+        graded = {}
+        for entry in parsed:
+            if isinstance(entry, dict) and entry.get('id') in expected_ids and 'score' in entry:
+                item_id = entry.pop('id')
+                graded[item_id] = entry
+        return graded
+    
+    def _parse_json_reply(self, response_text: str):
+        """Parse the JSON in a model reply (raises ValueError if there isn't any)."""
+        try:
+            return orjson.loads(response_text)
+        except orjson.JSONDecodeError:
+            # JSON mode replies are bare JSON, but older cached replies may be fenced
+            match = _JSON_RE.search(response_text)
+            if match is None:
+                raise
+            return orjson.loads(match.group(0))
     
     def format_feedback_message(self, grade_result: Dict, correct_answer: str = None) -> str:
         """
@@ -213,22 +904,18 @@ Be fair but thorough. If the user's response captures the essence of the answer
         feedback = grade_result.get('feedback', '')
         missing_points = grade_result.get('missing_points', [])
         
-        message = f"Your Score: {score}/100\n\n"
-        message += f"Feedback: {feedback}\n\n"
+        # One line per entry, joined once at the end
+        parts = [f"Your Score: {score}/100", "", f"Feedback: {feedback}", ""]
         
         if missing_points:
-            message += "Missing Points:\n"
-            for i, point in enumerate(missing_points, 1):
-                message += f"{i}. {point}\n"
-            message += "\n"
+            parts.append("Missing Points:")
+            parts.extend(f"{i}. {point}" for i, point in enumerate(missing_points, 1))
         else:
-            message += "Great job! You covered all the key points.\n\n"
+            parts.append("Great job! You covered all the key points.")
+        parts.append("")
         
         # Include the correct answer if provided
         if correct_answer:
-            message += "=" * 60 + "\n"
-            message += "Correct Answer:\n"
-            message += "=" * 60 + "\n"
-            message += f"{correct_answer}\n"
+            parts += [_SEP, "Correct Answer:", _SEP, correct_answer]
         
-        return message
+        return "\n".join(parts) + "\n"
@@ -1,78 +1,159 @@
 """Main service loop for the email quiz system."""
 import argparse
+import csv
 import json
 import os
 import random
 import time
-from datetime import datetime, timedelta
+from collections import deque
+from datetime import datetime
 from typing import Dict, Optional
-import pandas as pd
+import numpy as np
+import orjson
 import config
-from email_service import EmailService
-from grading_service import GradingService
+
+# Accepted CSV header names for each column (singular or plural)
+_COLUMN_NAMES = {'question': 'question', 'questions': 'question', 'answer': 'answer', 'answers': 'answer'}
+# How many recently asked questions are excluded from selection
+RECENT_QUESTIONS_LIMIT = 10
+# How many sent question/feedback message IDs are excluded from response detection
+SENT_MESSAGE_IDS_LIMIT = 10
+# Response polling keeps the base interval for POLL_BACKOFF_GRACE_SECONDS after a question
+# is sent, then backs off (doubling, up to this many times) while no reply arrives, but
+# never waits longer than POLL_MAX_INTERVAL_SECONDS between checks
+POLL_BACKOFF_GRACE_SECONDS = 300
+POLL_BACKOFF_MAX_DOUBLINGS = 6
+POLL_MAX_INTERVAL_SECONDS = 300
+# Weighted draws to try before giving up on redrawing past recently asked questions
+SAMPLE_MAX_DRAWS = 32
+
+
+def _ts() -> str:
+    """Local time for log lines, formatted by time.strftime without building a datetime."""
+    return time.strftime('%Y-%m-%d %H:%M:%S')
 
 
 class QuizService:
     """Main service that orchestrates the quiz system."""
     
     def __init__(self, email_subject: Optional[str] = None, reset_state: bool = False, reset_waiting: bool = True):
+        self.config = config.get_config()
+        
+        # Imported here so `--help` and other early exits don't pay for the Google client libraries
+        from email_service import EmailService
+        from grading_service import GradingService
         self.email_service = EmailService()
         self.grading_service = GradingService()
-        self.questions_df = None
-        self.email_subject = email_subject or config.EMAIL_SUBJECT
+        self.questions = []  # One {'question', 'answer', 'index'} dict per row, indexed by question_idx
+        self._weights = None  # Selection weight per question
+        self._cdf = None  # Cumulative sum of _weights
+        self.email_subject = email_subject or self.config.email_subject
         
         # Reset state completely if requested
         if reset_state:
-            if os.path.exists(config.STATE_FILE):
-                os.remove(config.STATE_FILE)
-            if os.path.exists(config.SCORES_FILE):
-                os.remove(config.SCORES_FILE)
+            if os.path.exists(self.config.state_file):
+                os.remove(self.config.state_file)
+            if os.path.exists(self.config.scores_file):
+                os.remove(self.config.scores_file)
             # Note: We don't clear progress file on reset - that's your history!
             print("✓ Cleared state and scores files (progress history preserved)")
         
+        # Files with unsaved changes; written together by _flush_dirty()
+        self._dirty = {'state': False, 'scores': False, 'progress': False}
+        
         self.state = self._load_state(reset_waiting=reset_waiting)
         self.scores = self._load_scores()
-        self.progress = self._load_progress()
+        self._migrate_progress_file()
+        self._unsaved_progress = []  # Entries not yet appended to the progress file
         self._load_questions()
     
     def _load_questions(self):
         """Load questions from CSV file."""
-        if not os.path.exists(config.QUESTIONS_CSV):
-            raise FileNotFoundError(f"Questions file not found: {config.QUESTIONS_CSV}")
+        if not os.path.exists(self.config.questions_csv):
+            raise FileNotFoundError(f"Questions file not found: {self.config.questions_csv}")
         
-        self.questions_df = pd.read_csv(config.QUESTIONS_CSV)
+        try:
+            # Optional Arrow CSV reader; falls back to the csv module if missing
+            import pyarrow as pa
+            from pyarrow import csv as pacsv
+        except ImportError:
+            pacsv = None
+        
+        # Read the header row and the rows, without building an intermediate DataFrame
+        if pacsv is not None:
+            # Answers contain quoted newlines, and every cell must stay a string (no type
+            # inference, no nulls) to match what the csv module gives
+            table = pacsv.read_csv(
+                self.config.questions_csv,
+                parse_options=pacsv.ParseOptions(newlines_in_values=True),
+                convert_options=pacsv.ConvertOptions(
+                    column_types={name: pa.string() for name in _COLUMN_NAMES},
+                    strings_can_be_null=False
+                )
+            )
+            headers = table.column_names
+        else:
+            with open(self.config.questions_csv, newline='', encoding='utf-8-sig') as f:
+                reader = csv.reader(f)
+                headers = next(reader, [])
+                rows = [row for row in reader if row]  # Skip blank lines
         
         # Handle both singular and plural column names
         # Normalize column names: 'questions' -> 'question', 'answers' -> 'answer'
-        column_mapping = {}
-        if 'questions' in self.questions_df.columns:
-            column_mapping['questions'] = 'question'
-        if 'answers' in self.questions_df.columns:
-            column_mapping['answers'] = 'answer'
-        
-        if column_mapping:
-            self.questions_df = self.questions_df.rename(columns=column_mapping)
+        column_positions = {}
+        for position, header in enumerate(headers):
+            name = _COLUMN_NAMES.get(header)
+            if name is not None:
+                column_positions.setdefault(name, position)
         
         # Validate CSV structure
-        required_columns = ['question', 'answer']
-        missing = [col for col in required_columns if col not in self.questions_df.columns]
+        missing = [col for col in ('question', 'answer') if col not in column_positions]
         if missing:
-            raise ValueError(f"CSV missing required columns: {missing}. Found columns: {list(self.questions_df.columns)}")
+            raise ValueError(f"CSV missing required columns: {missing}. Found columns: {list(headers)}")
+        
+        # Keep just the two columns as plain lists; question_idx is the row position
+        if pacsv is not None:
+            question_list = table.column(column_positions['question']).to_pylist()
+            answer_list = table.column(column_positions['answer']).to_pylist()
+        else:
+            question_pos, answer_pos = column_positions['question'], column_positions['answer']
+            question_list = [row[question_pos] if question_pos < len(row) else '' for row in rows]
+            answer_list = [row[answer_pos] if answer_pos < len(row) else '' for row in rows]
+        
+        # Built once so _select_random_question can hand back an entry as-is
+        self.questions = [
+            {'question': question, 'answer': answer, 'index': question_idx}
+            for question_idx, (question, answer) in enumerate(zip(question_list, answer_list))
+        ]
+        num_questions = len(self.questions)
+        
+        # Running average score per question (100 if never answered), kept in step with self.scores
+        self.avg_scores = np.full(num_questions, 100.0)
+        self._weights_dirty = True  # Selection weights need recomputing from avg_scores
+        self.score_counts = np.zeros(num_questions, dtype=np.int32)
+        for question_idx, question_scores in self.scores.items():
+            if question_idx < num_questions and question_scores:
+                self.avg_scores[question_idx] = sum(question_scores) / len(question_scores)
+                self.score_counts[question_idx] = len(question_scores)
+        self._unanswered = set(np.flatnonzero(self.score_counts == 0).tolist())  # Never-scored questions
         
         # Check if CSV file has changed (different number of questions)
         # If so, clear recent_questions and current_question_idx to avoid index mismatches
-        num_questions = len(self.questions_df)
-        if self.state.get('recent_questions'):
-            # Check if any recent question index is out of bounds
-            max_idx = max(self.state.get('recent_questions', [0]))
-            if max_idx >= num_questions:
-                print(f"⚠️  Warning: State has question indices that don't match new CSV ({num_questions} questions). Clearing recent questions.")
-                self.state['recent_questions'] = []
-                self.state['current_question_idx'] = None
-                self.state['current_question'] = None
-                self.state['current_answer'] = None
-        
-        print(f"Loaded {len(self.questions_df)} questions from {config.QUESTIONS_CSV}")
+        # Check if any recent question index is out of bounds
+        if max(self.state.get('recent_questions', []), default=-1) >= num_questions:
+            print(f"⚠️  Warning: State has question indices that don't match new CSV ({num_questions} questions). Clearing recent questions.")
+            self.state['recent_questions'] = []
+            self.state['current_question_idx'] = None
+            self.state['current_question'] = None
+            self.state['current_answer'] = None
+        
+        # Recently asked questions as a ring buffer plus a per-question flag, updated in place
+        self._recent_ring = deque(self.state.get('recent_questions', []), maxlen=RECENT_QUESTIONS_LIMIT)
+        self._recent_mask = np.zeros(num_questions, dtype=bool)
+        self._recent_mask[list(self._recent_ring)] = True
+        self.state['recent_questions'] = self._recent_ring  # Saved as a list by config.save_json
+        
+        print(f"Loaded {num_questions} questions from {self.config.questions_csv}")
     
     def _load_state(self, reset_waiting: bool = True) -> Dict:
         """Load state from JSON file.
@@ -80,10 +161,18 @@ class QuizService:
         Args:
             reset_waiting: If True, reset waiting state on startup (default: True)
         """
-        if os.path.exists(config.STATE_FILE):
+        if os.path.exists(self.config.state_file):
             try:
-                with open(config.STATE_FILE, 'r') as f:
-                    state = json.load(f)
+                state = config.load_json(self.config.state_file)
+                
+                # Older state files stored last_question_time as an ISO string; use epoch seconds
+                if isinstance(state.get('last_question_time'), str):
+                    state['last_question_time'] = datetime.fromisoformat(state['last_question_time']).timestamp()
+                
+                # Normalize once so later code can treat recent_questions as plain ints
+                state['recent_questions'] = [int(q) for q in state.get('recent_questions', [])]
+                # Bounded in memory so appends evict the oldest ID
+                state['sent_message_ids'] = deque(state.get('sent_message_ids', []), maxlen=SENT_MESSAGE_IDS_LIMIT)
                 
                 # Reset waiting state on startup to allow new questions
                 if reset_waiting:
@@ -101,10 +190,10 @@ class QuizService:
                 
                 return state
             except json.JSONDecodeError:
-                print(f"Warning: Could not parse {config.STATE_FILE}, starting fresh")
+                print(f"Warning: Could not parse {self.config.state_file}, starting fresh")
         
         # Ensure thread_id is None if empty string
-        thread_id = config.EMAIL_THREAD_ID
+        thread_id = self.config.email_thread_id
         if not thread_id or (isinstance(thread_id, str) and thread_id.strip() == ''):
             thread_id = None
         
@@ -113,44 +202,55 @@ class QuizService:
             'current_answer': None,
             'thread_id': thread_id,
             'sent_message_id': None,
-            'last_question_time': None,
+            'last_question_time': None,  # Epoch seconds
             'waiting_for_response': False,
-            'recent_questions': []  # Track recently asked questions
+            'recent_questions': [],  # Track recently asked questions
+            'sent_message_ids': deque(maxlen=SENT_MESSAGE_IDS_LIMIT)
         }
     
     def _load_scores(self) -> Dict:
         """Load question scores from JSON file."""
-        if os.path.exists(config.SCORES_FILE):
+        if os.path.exists(self.config.scores_file):
             try:
-                with open(config.SCORES_FILE, 'r') as f:
-                    scores = json.load(f)
-                    # Convert string keys to ints
-                    return {int(k): v for k, v in scores.items()}
+                scores = config.load_json(self.config.scores_file)
+                # Convert string keys to ints
+                return {int(k): v for k, v in scores.items()}
             except (json.JSONDecodeError, ValueError):
-                print(f"Warning: Could not parse {config.SCORES_FILE}, starting fresh")
+                print(f"Warning: Could not parse {self.config.scores_file}, starting fresh")
         
         return {}  # {question_index: [list of scores]}
     
     def _save_scores(self):
         """Save question scores to JSON file."""
-        with open(config.SCORES_FILE, 'w') as f:
-            json.dump(self.scores, f, indent=2)
+        config.save_json(self.config.scores_file, self.scores)
     
-    def _load_progress(self) -> list:
-        """Load progress history from JSON file."""
-        if os.path.exists(config.PROGRESS_FILE):
-            try:
-                with open(config.PROGRESS_FILE, 'r') as f:
-                    return json.load(f)
-            except json.JSONDecodeError:
-                print(f"Warning: Could not parse {config.PROGRESS_FILE}, starting fresh")
+    def _migrate_progress_file(self):
+        """Convert an old JSON-array progress file to JSON Lines, so new entries can be appended."""
+        if not os.path.exists(self.config.progress_file):
+            return
+        
+        # JSON Lines history is never read back, so only peek at the start of the file
+        with open(self.config.progress_file, 'rb') as f:
+            if not f.read(64).lstrip().startswith(b'['):
+                return
+            f.seek(0)
+            content = f.read()
         
-        return []
+        # Older versions stored the history as one JSON array; convert it once
+        try:
+            progress = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            print(f"Warning: Could not parse {self.config.progress_file}, leaving it as is")
+            return
+        tmp_path = self.config.progress_file + '.tmp'
+        config.write_jsonl(tmp_path, progress, append=False)
+        os.replace(tmp_path, self.config.progress_file)
+        print(f"✓ Converted {self.config.progress_file} to one entry per line")
     
     def _save_progress(self):
-        """Save progress history to JSON file."""
-        with open(config.PROGRESS_FILE, 'w') as f:
-            json.dump(self.progress, f, indent=2)
+        """Append progress entries recorded since the last save to the progress file."""
+        config.write_jsonl(self.config.progress_file, self._unsaved_progress)
+        self._unsaved_progress = []
     
     def _record_progress(self, question: str, user_response: str, feedback: str, score: int, question_idx: Optional[int] = None):
         """Record a progress entry with timestamp."""
@@ -162,41 +262,54 @@ class QuizService:
             'feedback': feedback,
             'score': score
         }
-        self.progress.append(entry)
-        self._save_progress()
-        print(f"✓ Progress recorded to {config.PROGRESS_FILE}")
+        self._unsaved_progress.append(entry)
+        self._dirty['progress'] = True
+        print(f"✓ Progress recorded to {self.config.progress_file}")
     
     def _record_score(self, question_idx: int, score: int):
         """Record a score for a question."""
         if question_idx not in self.scores:
             self.scores[question_idx] = []
         self.scores[question_idx].append(score)
-        self._save_scores()
+        
+        # Skip indices left over from a previous, longer CSV
+        if question_idx < len(self.avg_scores):
+            count = self.score_counts[question_idx]
+            self.avg_scores[question_idx] = (self.avg_scores[question_idx] * count + score) / (count + 1)
+            self.score_counts[question_idx] = count + 1
+            self._weights_dirty = True
+            self._unanswered.discard(question_idx)
+        self._dirty['scores'] = True
     
     def _get_average_score(self, question_idx: int) -> float:
         """Get the average score for a question. Returns 100 if never answered."""
+        # O(1) from the running average, unless the index predates the current CSV
+        if question_idx < len(self.avg_scores):
+            return float(self.avg_scores[question_idx])
         if question_idx not in self.scores or len(self.scores[question_idx]) == 0:
             return 100.0  # Default to 100 (perfect) if never answered
         return sum(self.scores[question_idx]) / len(self.scores[question_idx])
     
     def _save_state(self):
         """Save current state to JSON file."""
-        # Convert numpy/pandas types to native Python types for JSON serialization
-        def convert_to_native(obj):
-            if isinstance(obj, dict):
-                return {k: convert_to_native(v) for k, v in obj.items()}
-            elif isinstance(obj, list):
-                return [convert_to_native(item) for item in obj]
-            elif hasattr(obj, 'item'):  # numpy/pandas scalar types
-                return obj.item()
-            elif isinstance(obj, (int, float, str, bool)) or obj is None:
-                return obj
-            else:
-                return str(obj)  # Fallback: convert to string
-        
-        state_to_save = convert_to_native(self.state)
-        with open(config.STATE_FILE, 'w') as f:
-            json.dump(state_to_save, f, indent=2)
+        # orjson writes numpy scalars (e.g. int64 indices) directly
+        config.save_json(self.config.state_file, self.state)
+    
+    def _flush_dirty(self):
+        """Write the state, scores and progress files that have changed since the last flush."""
+        savers = {'state': self._save_state, 'scores': self._save_scores, 'progress': self._save_progress}
+        for name, save in savers.items():
+            if self._dirty[name]:
+                save()
+                self._dirty[name] = False
+    
+    def _mark_recent(self, question_idx: int):
+        """Add a question to the recent ring (keep last 10), un-flagging the one that drops out."""
+        evicted = self._recent_ring[0] if len(self._recent_ring) == self._recent_ring.maxlen else None
+        self._recent_ring.append(question_idx)
+        if evicted is not None and evicted not in self._recent_ring:
+            self._recent_mask[evicted] = False
+        self._recent_mask[question_idx] = True
     
     def _select_random_question(self) -> Dict:
         """
@@ -204,95 +317,65 @@ class QuizService:
         1. First, prioritize questions that have never been answered
         2. Once all questions have been answered at least once, prioritize by lowest average score
         """
-        # Filter out recently asked questions (last 10)
-        # Convert to native ints for comparison
-        recent = set(int(q) for q in self.state.get('recent_questions', []))
-        available = self.questions_df[~self.questions_df.index.isin(recent)]
+        # Recently asked questions (last 10) are skipped via _recent_mask
+        num_questions = len(self.questions)
         
         # If all questions have been asked recently, reset
-        if len(available) == 0:
-            available = self.questions_df
-            self.state['recent_questions'] = []
-        
-        # Separate questions into: unanswered vs answered
-        unanswered_indices = []
-        answered_indices = []
+        if self._recent_mask.all():
+            self._recent_ring.clear()
+            self._recent_mask[:] = False
         
-        for idx, row in available.iterrows():
-            question_idx = int(idx)
-            # Check if question has been answered (has scores recorded)
-            if question_idx not in self.scores or len(self.scores[question_idx]) == 0:
-                unanswered_indices.append(question_idx)
-            else:
-                answered_indices.append(question_idx)
+        # Unanswered questions that weren't asked recently
+        unanswered_indices = [idx for idx in self._unanswered if not self._recent_mask[idx]]
         
         # Strategy 1: If there are unanswered questions, prioritize them
         if len(unanswered_indices) > 0:
             # Randomly select from unanswered questions (equal probability)
-            selected_idx = random.choice(unanswered_indices)
-            selected = self.questions_df.loc[selected_idx]
-            question_idx = int(selected_idx)
+            question_idx = random.choice(unanswered_indices)
             
-            # Update recent questions (keep last 10)
-            recent_questions = [int(q) if hasattr(q, 'item') else int(q) for q in self.state.get('recent_questions', [])]
-            self.state['recent_questions'] = (recent_questions + [question_idx])[-10:]
+            self._mark_recent(question_idx)
             
             print(f"Selected question (unanswered, {len(unanswered_indices)} remaining)")
-            return {
-                'question': selected['question'],
-                'answer': selected['answer'],
-                'index': question_idx
-            }
+            return self.questions[question_idx]
         
         # Strategy 2: All questions have been answered at least once
         # Now prioritize by lowest average score
-        total_questions = len(self.questions_df)
+        total_questions = num_questions
         answered_count = len(self.scores)
         print(f"Progress: {answered_count}/{total_questions} questions answered at least once")
         
-        # Calculate weights based on scores (lower scores = higher weight)
-        # Weight = (101 - average_score) to invert: score 0 = weight 101, score 100 = weight 1
-        weights = []
-        available_indices = []
-        
-        for idx, row in available.iterrows():
-            question_idx = int(idx)
-            avg_score = self._get_average_score(question_idx)
-            # Weight inversely proportional to score (lower score = higher weight)
-            # Use a stronger weighting: (101 - score)^2 to make low scores much more likely
-            weight = (101.0 - avg_score) ** 2
-            # Minimum weight of 1 to ensure all questions have some chance
-            weight = max(1.0, weight)
-            weights.append(weight)
-            available_indices.append(question_idx)
-        
-        # Normalize weights to probabilities
-        total_weight = sum(weights)
-        if total_weight > 0:
-            probabilities = [w / total_weight for w in weights]
-        else:
-            # Equal probability if all weights are 0 (shouldn't happen)
-            probabilities = [1.0 / len(weights)] * len(weights)
+        # Weights only change when a score is recorded, so reuse them (and their CDF) until then
+        if self._weights_dirty:
+            # Calculate weights based on scores (lower scores = higher weight)
+            # Weight = (101 - average_score)^2 to make low scores much more likely
+            # (score 0 = weight 10201, score 100 = weight 1), with a minimum weight
+            # of 1 so all questions keep some chance
+            self._weights = np.maximum(1.0, (101.0 - self.avg_scores) ** 2)
+            self._cdf = np.cumsum(self._weights)
+            self._weights_dirty = False
+        
+        # Sample over all questions by binary search on the CDF, redrawing if we land on a
+        # recent one; that leaves the same distribution as sampling only the available ones
+        question_idx = None
+        for _ in range(SAMPLE_MAX_DRAWS):
+            candidate = int(np.searchsorted(self._cdf, random.random() * self._cdf[-1], side='right'))
+            if not self._recent_mask[candidate]:
+                question_idx = candidate
+                break
         
-        # Select question based on weighted probabilities
-        selected_idx = random.choices(available_indices, weights=probabilities, k=1)[0]
-        selected = self.questions_df.loc[selected_idx]
-        question_idx = int(selected_idx)
+        if question_idx is None:
+            # Recent questions hold most of the weight; sample from the rest directly
+            available_indices = np.flatnonzero(~self._recent_mask)
+            weights = self._weights[available_indices]
+            question_idx = int(np.random.choice(available_indices, p=weights / weights.sum()))
         
-        # Update recent questions (keep last 10)
-        # Convert any existing int64 values to native ints
-        recent_questions = [int(q) if hasattr(q, 'item') else int(q) for q in self.state.get('recent_questions', [])]
-        self.state['recent_questions'] = (recent_questions + [question_idx])[-10:]
+        self._mark_recent(question_idx)
         
         # Show selection info
         avg_score = self._get_average_score(question_idx)
         print(f"Selected question (avg score: {avg_score:.1f}/100, prioritizing lowest scores)")
         
-        return {
-            'question': selected['question'],
-            'answer': selected['answer'],
-            'index': question_idx
-        }
+        return self.questions[question_idx]
     
     def _should_send_new_question(self) -> bool:
         """Check if it's time to send a new question."""
@@ -307,15 +390,13 @@ class QuizService:
             return True
         
         # Otherwise, check if enough time has passed
-        last_time_str = self.state['last_question_time']
-        last_time = datetime.fromisoformat(last_time_str)
-        interval = timedelta(minutes=config.QUESTION_INTERVAL_MINUTES)
-        time_since = datetime.now() - last_time
+        interval = self.config.question_interval_minutes * 60
+        time_since = time.time() - self.state['last_question_time']
         
         should_send = time_since >= interval
         if not should_send:
             remaining = interval - time_since
-            print(f"[DEBUG] Not time yet. {remaining.total_seconds()/60:.1f} minutes remaining until next question.")
+            print(f"[DEBUG] Not time yet. {remaining/60:.1f} minutes remaining until next question.")
         
         return should_send
     
@@ -323,7 +404,7 @@ class QuizService:
         """Send a new question via email."""
         question_data = self._select_random_question()
         
-        print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Sending question...")
+        print(f"\n[{_ts()}] Sending question...")
         print(f"Question: {question_data['question'][:100]}...")
         print(f"Subject: {self.email_subject}")
         
@@ -342,16 +423,13 @@ class QuizService:
                 subject=self.email_subject
             )
             
-            # Get the actual message to get its timestamp
+            # Get the message's Gmail timestamp (this also caches it for the response check)
             try:
-                sent_msg = self.email_service.service.users().messages().get(
-                    userId='me', id=result['id']
-                ).execute()
-                sent_message_timestamp = int(sent_msg.get('internalDate', 0))
+                sent_message_timestamp = self.email_service.get_message_timestamp(result['id'])
             except Exception as e:
                 # Fallback to current time if we can't get message
                 print(f"Warning: Could not get message timestamp: {e}")
-                sent_message_timestamp = int(datetime.now().timestamp() * 1000)
+                sent_message_timestamp = int(time.time() * 1000)
             
             # Update state
             self.state['current_question'] = question_data['question']
@@ -360,17 +438,13 @@ class QuizService:
             self.state['sent_message_id'] = result['id']
             self.state['sent_message_timestamp'] = sent_message_timestamp
             self.state['thread_id'] = result['threadId']
-            self.state['last_question_time'] = datetime.now().isoformat()
+            self.state['last_question_time'] = time.time()
             self.state['waiting_for_response'] = True
             
-            # Track all sent message IDs to exclude from response detection
-            if 'sent_message_ids' not in self.state:
-                self.state['sent_message_ids'] = []
+            # Track all sent message IDs to exclude from response detection (keeps the last 10)
             self.state['sent_message_ids'].append(result['id'])
-            # Keep only last 10 to avoid growing too large
-            self.state['sent_message_ids'] = self.state['sent_message_ids'][-10:]
             
-            self._save_state()
+            self._dirty['state'] = True
             
             print(f"✓ Question sent successfully!")
             print(f"  Message ID: {result['id']}")
@@ -384,7 +458,7 @@ class QuizService:
             # Don't raise - allow service to continue and try again later
             self.state['waiting_for_response'] = False
             self.state['sent_message_id'] = None
-            self._save_state()
+            self._dirty['state'] = True
     
     def _check_for_response(self) -> Optional[str]:
         """Check if there's a response to the current question."""
@@ -435,7 +509,7 @@ class QuizService:
             print("Error: Missing question or answer in state")
             return
         
-        print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Grading response...")
+        print(f"\n[{_ts()}] Grading response...")
         print(f"User response: {user_response[:100]}...")
         
         try:
@@ -464,13 +538,9 @@ class QuizService:
             )
             
             # Track feedback message ID so we don't pick it up as a response
-            if 'sent_message_ids' not in self.state:
-                self.state['sent_message_ids'] = []
             if feedback_result and 'id' in feedback_result:
                 self.state['sent_message_ids'].append(feedback_result['id'])
-                # Keep only last 10 to avoid growing too large
-                self.state['sent_message_ids'] = self.state['sent_message_ids'][-10:]
-                self._save_state()
+                self._dirty['state'] = True
             
             # Record progress history
             self._record_progress(
@@ -490,13 +560,13 @@ class QuizService:
             self.state['current_question_idx'] = None
             self.state['sent_message_id'] = None
             self.state['sent_message_timestamp'] = None
-            self._save_state()
+            self._dirty['state'] = True
             
         except Exception as e:
             print(f"Error grading response: {e}")
             # Still mark as not waiting so we can continue
             self.state['waiting_for_response'] = False
-            self._save_state()
+            self._dirty['state'] = True
     
     def run(self):
         """Main service loop."""
@@ -511,47 +581,65 @@ class QuizService:
             print(f"Configuration error: {e}")
             return
         
-        print(f"Target email: {config.TARGET_EMAIL}")
-        print(f"Question interval: {config.QUESTION_INTERVAL_MINUTES} minutes")
-        print(f"Poll interval: {config.POLL_INTERVAL_SECONDS} seconds")
+        print(f"Target email: {self.config.target_email}")
+        print(f"Question interval: {self.config.question_interval_minutes} minutes")
+        print(f"Poll interval: {self.config.poll_interval_seconds} seconds")
         print("\nPress Ctrl+C to stop the service\n")
         
+        poll_misses = 0  # Response checks in a row that found nothing, after the grace period
+        timeout_interval = self.config.question_interval_minutes * 2 * 60  # Reply deadline
+        
         try:
             while True:
                 # Check if we should send a new question
                 if not self.state.get('waiting_for_response') and self._should_send_new_question():
-                    print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Ready to send new question...")
+                    print(f"\n[{_ts()}] Ready to send new question...")
                     self._send_question()
                 
                 # Check for responses if we're waiting
                 if self.state.get('waiting_for_response'):
-                    # Check if we've been waiting too long (timeout after 2x the question interval)
-                    last_time_str = self.state.get('last_question_time')
-                    if last_time_str:
-                        last_time = datetime.fromisoformat(last_time_str)
-                        timeout_interval = timedelta(minutes=config.QUESTION_INTERVAL_MINUTES * 2)
-                        if datetime.now() - last_time >= timeout_interval:
-                            print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Timeout: No response received. Resetting state to send new question.")
-                            self.state['waiting_for_response'] = False
-                            self.state['sent_message_id'] = None
-                            self._save_state()
-                            continue
-                    
                     # Only check for response, don't spam waiting messages
                     response = self._check_for_response()
+                    last_time = self.state.get('last_question_time')
+                    waited = time.time() - last_time if last_time else 0
                     if response:
+                        poll_misses = 0
                         current_question = self.state.get('current_question', 'Unknown')
-                        print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Response received!")
+                        print(f"\n[{_ts()}] Response received!")
                         print(f"Question: {current_question[:50]}...")
                         print(f"Response: {response[:100]}...")
                         self._grade_and_send_feedback(response)
+                    elif waited >= timeout_interval:
+                        # Waited too long (timeout after 2x the question interval); checked once more first
+                        print(f"\n[{_ts()}] Timeout: No response received. Resetting state to send new question.")
+                        self.state['waiting_for_response'] = False
+                        self.state['sent_message_id'] = None
+                        self._dirty['state'] = True
+                        continue
+                    elif waited >= POLL_BACKOFF_GRACE_SECONDS:
+                        poll_misses += 1
+                
+                # Write everything this iteration changed in one go
+                self._flush_dirty()
                 
-                # Sleep before next iteration
-                time.sleep(config.POLL_INTERVAL_SECONDS)
+                # Sleep before next iteration, longer once a reply is overdue
+                sleep_seconds = self.config.poll_interval_seconds
+                last_time = self.state.get('last_question_time')
+                if self.state.get('waiting_for_response') and last_time:
+                    sleep_seconds = min(
+                        POLL_MAX_INTERVAL_SECONDS,
+                        sleep_seconds * 2 ** min(poll_misses, POLL_BACKOFF_MAX_DOUBLINGS)
+                    )
+                    # Never sleep past the reply deadline, so a late reply is still caught in time
+                    sleep_seconds = max(0, min(sleep_seconds, timeout_interval - (time.time() - last_time)))
+                else:
+                    poll_misses = 0
+                time.sleep(sleep_seconds)
                 
         except KeyboardInterrupt:
             print("\n\nService stopped by user.")
-            self._save_state()
+            self._dirty['state'] = True
+            self._flush_dirty()
             print("State saved.")
 
 